@@ -0,0 +1,114 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from dependencies.configops import MainConfig
+from dependencies.deepb import deepdanbooruModel, load_image
+
+# CPU throughput of deepdanbooruModel.classify_images at several batch sizes, plus a check that
+# batched tags match single-image tags, then preprocessing time per image with and without fast_decode and how
+# far its pixels, scores and tags drift from a full-resolution decode, exiting with status 1 if any drift is over
+# its tolerance. Run that before turning on [deepb] fastdecode; --decode-only checks the pixels without the model.
+# Uses the model from config.ini and random images unless --folder is given.
+
+
+def sample_images(folder, count, size):
+    if folder:
+        paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                 if name.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp"))]
+        return paths[:count]
+    tempdir = tempfile.mkdtemp(prefix="deepb-bench-")
+    rng = np.random.default_rng(0)
+    width, height = size
+    paths = []
+    for i in range(count):
+        path = os.path.join(tempdir, f"{i}.jpg")
+        # blurry blobs with a little grain, closer to a photo than pure noise and much faster to write
+        blobs = Image.fromarray(rng.integers(0, 255, (height // 64, width // 64, 3), dtype=np.uint8))
+        grain = rng.integers(-12, 12, (height, width, 3), dtype=np.int16)
+        pixels = np.asarray(blobs.resize((width, height), Image.BICUBIC), dtype=np.int16) + grain
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def time_preprocessing(paths, fast_decode):
+    start = time.perf_counter()
+    images = np.stack([load_image(path, fast_decode) for path in paths])
+    return images, (time.perf_counter() - start) / len(paths)
+
+
+def compare_decoders(paths, model, tolerances):
+    # returns the tolerances fast_decode exceeded; pixel drift is in 0-255 steps, model checks need a model
+    full, full_time = time_preprocessing(paths, False)
+    fast, fast_time = time_preprocessing(paths, True)
+    print(f"preprocessing: {full_time * 1000:.1f} ms/image full decode, {fast_time * 1000:.1f} ms/image fast decode "
+          f"({full_time / fast_time:.1f}x)")
+    drift = np.abs(full - fast) * 255
+    print(f"pixel drift: max {drift.max():.2f}, mean {drift.mean():.3f} (of 255)")
+    failures = []
+    if drift.max() > tolerances.max_pixel_drift:
+        failures.append(f"max pixel drift {drift.max():.2f} > {tolerances.max_pixel_drift}")
+    if drift.mean() > tolerances.max_mean_pixel_drift:
+        failures.append(f"mean pixel drift {drift.mean():.3f} > {tolerances.max_mean_pixel_drift}")
+    if model is None:
+        return failures
+    full_scores = np.concatenate([model.score_arrays(full[i:i + 16]) for i in range(0, len(paths), 16)])
+    fast_scores = np.concatenate([model.score_arrays(fast[i:i + 16]) for i in range(0, len(paths), 16)])
+    full_tags, fast_tags = full_scores > model.threshold, fast_scores > model.threshold
+    union = (full_tags | fast_tags).sum(axis=1)
+    overlap = np.where(union, (full_tags & fast_tags).sum(axis=1) / np.maximum(union, 1), 1.0)
+    score_drift = np.abs(full_scores - fast_scores)
+    print(f"score drift: max {score_drift.max():.4f}, mean {score_drift.mean():.6f}; "
+          f"tag sets differ on {int((full_tags != fast_tags).any(axis=1).sum())} of {len(paths)} images, "
+          f"mean overlap {overlap.mean():.3f}, worst {overlap.min():.3f}")
+    if score_drift.max() > tolerances.max_score_drift:
+        failures.append(f"max score drift {score_drift.max():.4f} > {tolerances.max_score_drift}")
+    if overlap.min() < tolerances.min_tag_overlap:
+        failures.append(f"worst tag overlap {overlap.min():.3f} < {tolerances.min_tag_overlap}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched DeepDanbooru inference on CPU")
+    parser.add_argument("--folder", help="folder of images to use instead of random ones")
+    parser.add_argument("--count", type=int, default=64, help="images per run")
+    parser.add_argument("--batchsizes", default="1,8,16,32")
+    parser.add_argument("--size", default="4000x3000", help="WxH of the random images")
+    parser.add_argument("--decode-only", action="store_true",
+                        help="only check fast_decode's preprocessing, without TensorFlow or the model")
+    parser.add_argument("--max-pixel-drift", type=float, default=4.0, help="largest pixel difference, of 255")
+    parser.add_argument("--max-mean-pixel-drift", type=float, default=1.0, help="largest mean pixel difference")
+    parser.add_argument("--max-score-drift", type=float, default=0.05, help="largest tag score difference")
+    parser.add_argument("--min-tag-overlap", type=float, default=0.9,
+                        help="smallest share of tags kept on any one image")
+    args = parser.parse_args()
+    paths = sample_images(args.folder, args.count, tuple(int(side) for side in args.size.split("x")))
+    model = None
+    if not args.decode_only:
+        os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")
+        config = MainConfig("config.ini")
+        model = deepdanbooruModel(config.deepbthreshold, config.deepbmodelpath, config.deepbtagfile)
+        model.classify_images(paths[:1])  # warm up
+        single = [model.classify_image(path) for path in paths]
+        for batchsize in [int(size) for size in args.batchsizes.split(",")]:
+            start = time.perf_counter()
+            results = model.classify_images(paths, batchsize)
+            elapsed = time.perf_counter() - start
+            mismatched = sum(1 for a, b in zip(single, results) if a != b)
+            print(f"batch {batchsize:>3}: {len(paths) / elapsed:.2f} images/s, "
+                  f"{mismatched} of {len(paths)} differ from single-image tags")
+    failures = compare_decoders(paths, model, args)
+    if failures:
+        print("fast_decode is outside tolerance: " + "; ".join(failures))
+        sys.exit(1)
+    print("fast_decode is within tolerance")
+
+
+if __name__ == "__main__":
+    main()
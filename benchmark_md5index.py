@@ -0,0 +1,61 @@
+import argparse
+import hashlib
+import time
+import tracemalloc
+
+from dependencies.md5index import MD5Index
+
+# Compares a set of hex MD5 strings (what client.py used to load at startup) against MD5Index,
+# on synthetic hashes so it runs without MongoDB.
+
+
+def fake_md5s(count, seed=0):
+    return [hashlib.md5(f"{seed}-{i}".encode()).hexdigest() for i in range(count)]
+
+
+def fake_cursor(digests):
+    # new str objects per document, as a MongoDB cursor would produce
+    for digest in digests:
+        yield digest.hex()
+
+
+def measure(build, digests):
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = build(fake_cursor(digests))
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, elapsed, current, peak
+
+
+def lookups(index, probes):
+    start = time.perf_counter()
+    found = sum(1 for md5 in probes if md5 in index)
+    return found, len(probes) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark startup MD5 sets against MD5Index")
+    parser.add_argument("--count", type=int, default=2000000, help="number of MD5s to load")
+    parser.add_argument("--probes", type=int, default=200000, help="number of lookups to time")
+    args = parser.parse_args()
+    md5s = fake_md5s(args.count)
+    probes = md5s[: args.probes // 2] + fake_md5s(args.probes // 2, seed=1)
+    digests = [bytes.fromhex(md5) for md5 in md5s]
+    del md5s[args.probes // 2:]
+    for name, build in (("set", set), ("MD5Index", MD5Index.build)):
+        index, elapsed, current, peak = measure(build, digests)
+        found, rate = lookups(index, probes)
+        print(f"{name:>8}: build {elapsed:.2f}s, held {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB, "
+              f"{rate:,.0f} lookups/s ({found} found)")
+        if isinstance(index, MD5Index):
+            start = time.perf_counter()
+            found = int(index.contains_many(probes).sum())
+            rate = len(probes) / (time.perf_counter() - start)
+            print(f"{'':>8}  contains_many: {rate:,.0f} lookups/s ({found} found)")
+        del index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import difflib
+import os
+
+from dependencies.configops import MainConfig
+from dependencies.vision import Tagging
+from dependencies.visionupload import UploadPreprocessor
+
+# Regression check for the Vision upload preprocessor: annotates each image in --folder twice, once from the original
+# bytes and once from what UploadPreprocessor sends with the settings in config.ini, then reports the bytes saved
+# and how far labels (set overlap) and OCR text (similarity ratio) moved. Images under the thresholds are listed.
+# Every image costs two Vision requests; --endpoint with fake_vision_server.py only checks the plumbing.
+
+
+def compare(original, shrunk):
+    tags_a, tags_b = set(original["tags"]), set(shrunk["tags"])
+    overlap = len(tags_a & tags_b) / len(tags_a | tags_b) if tags_a | tags_b else 1.0
+    text_a, text_b = (original["text"] or [""])[0], (shrunk["text"] or [""])[0]
+    return overlap, difflib.SequenceMatcher(None, text_a, text_b).ratio()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Vision labels and OCR on original and shrunk uploads")
+    parser.add_argument("folder", help="folder of images to check")
+    parser.add_argument("--count", type=int, default=50, help="images to check")
+    parser.add_argument("--screenshots", action="store_true", help="treat the images as screenshots")
+    parser.add_argument("--endpoint", help="Vision endpoint to use instead of the one in config.ini")
+    parser.add_argument("--min-tags", type=float, default=0.7, help="lowest acceptable label overlap")
+    parser.add_argument("--min-text", type=float, default=0.9, help="lowest acceptable OCR similarity")
+    args = parser.parse_args()
+    config = MainConfig("config.ini")
+    tagging = Tagging(config.google_credentials, config.google_project, "google-vision",
+                      endpoint=args.endpoint or config.vision_endpoint)
+    uploader = UploadPreprocessor(config.visionmaxside or 2048, config.visionuploadformat,
+                                  config.visionuploadquality, config.visionscreenshotfullres)
+    is_screenshot = 1 if args.screenshots else 0
+    paths = [os.path.join(args.folder, name) for name in sorted(os.listdir(args.folder))
+             if name.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff"))]
+    overlaps, similarities, regressions = [], [], []
+    for path in paths[:args.count]:
+        with open(path, "rb") as file:
+            content = file.read()
+        upload = uploader.prepare(content, is_screenshot)
+        features = ("tags", "text")
+        original = tagging.annotate(content, features)
+        shrunk = original if upload is content else tagging.annotate(upload, features)
+        overlap, similarity = compare(original, shrunk)
+        overlaps.append(overlap)
+        similarities.append(similarity)
+        if overlap < args.min_tags or similarity < args.min_text:
+            regressions.append((path, len(content), len(upload), overlap, similarity))
+    if not overlaps:
+        print("no images found")
+        return
+    stats = uploader.stats()
+    print(f"{stats['images']} images, {stats['resized']} resized, {stats['reencoded']} re-encoded: "
+          f"{stats['bytes_in'] / 1e6:.1f} MB -> {stats['bytes_out'] / 1e6:.1f} MB ({stats['saved_pct']}% saved), "
+          f"{stats['mean_encode_ms']} ms/image")
+    print(f"label overlap: mean {sum(overlaps) / len(overlaps):.3f}, worst {min(overlaps):.3f}; "
+          f"OCR similarity: mean {sum(similarities) / len(similarities):.3f}, worst {min(similarities):.3f}")
+    for path, size_in, size_out, overlap, similarity in regressions:
+        print(f"  below threshold: {path} ({size_in} -> {size_out} bytes) labels {overlap:.3f}, text {similarity:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
+import argparse
 import concurrent.futures
 import datetime
-import json
 import logging
+import multiprocessing
+import queue
+import subprocess
 import sys
 import threading
 import time
@@ -10,7 +13,11 @@ import pymongo
 from redis import Redis
 
 from dependencies.configops import MainConfig
-from dependencies.fileops import get_image_md5, get_video_content_md5, listdirs, listimages, listvideos
+from dependencies.fileops import (close_hash_cache, configure_ffmpeg_pool, get_image_pixel_md5, get_video_md5,
+                                  open_hash_cache, scan_media, share_large_decode_lock)
+from dependencies.jobqueue import JobPusher
+from dependencies.md5index import LayeredMD5Index, MD5Index
+from dependencies.scanjournal import ScanJournal
 
 # initialize logger
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
@@ -25,137 +32,375 @@ currentdb = pymongo.MongoClient(config.connectstring)[config.mongodbname]
 collection = currentdb[config.mongocollection]
 screenshotcollection = currentdb[config.mongoscreenshotcollection]
 videocollection = currentdb[config.mongovideocollection]
-collection.create_index([("md5", pymongo.TEXT)], name="md5_index", unique=True)
-collection.create_index("vision_tags")
-screenshotcollection.create_index([("md5", pymongo.TEXT)], name="md5_index", unique=True)
-videocollection.create_index("content_md5")
-videocollection.create_index("vision_tags")
 
 # Initialize variables
 imagecount, videocount, queuedimagecount, queuedvideocount = 0, 0, 0, 0
-foldercount = 0
-imagecount_lock = threading.Lock()
-videocount_lock = threading.Lock()
-queuedimagecount_lock = threading.Lock()
-queuedvideocount_lock = threading.Lock()
+foldercount, skippedfoldercount = 0, 0
+foldercount_lock = threading.Lock()
+allmd5s, videomd5s, deepbmd5s, visionmd5s, explicitmd5s = MD5Index(), MD5Index(), MD5Index(), MD5Index(), MD5Index()
+# per-model bits in the image MD5Index, and cursor batch size for loading it
+FLAG_PRESENT, FLAG_DEEPB, FLAG_VISION, FLAG_EXPLICIT = 1, 2, 4, 8
+MD5_BATCH_SIZE = 10000
+# md5lookup = batch: indexes whose bottom layer holds the current batch's query results
+imagelayers, videolayers = None, None
+lookupqueries, lookuptime = 0, 0.0
+hashcache = None
+pusher = None
 
 REDIS_CLIENT = Redis(host='localhost', port=6379, db=0)
 
-logger.info("Loading md5s from MongoDB")
-allmd5s = set([x["md5"] for x in collection.find({}, {"md5": 1, "_id": 0})])
-# possibly because of entryies with no content md5?
-videomd5s = set()
-for x in videocollection.find({"content_md5": {"$exists": True}}, {"content_md5": 1, "_id": 0}):
-    if isinstance(x["content_md5"], list):
-        for y in x["content_md5"]: videomd5s.add(y)
-    else: videomd5s.add(x["content_md5"])
-deepbmd5s = set([x["md5"] for x in collection.find({"deepbtags": {"$exists": True}}, {"md5": 1, "_id": 0})])
-visionmd5s = set([x["md5"] for x in collection.find({"vision_tags": {"$exists": True}}, {"md5": 1, "_id": 0})])
-explicitmd5s = set([x["md5"] for x in collection.find({"explicit_detection": {"$exists": True}}, {"md5": 1, "_id": 0})])
-logger.info("Loaded md5s from MongoDB")
 
+def create_indexes():
+    collection.create_index([("md5", pymongo.TEXT)], name="md5_index", unique=True)
+    # text indexes can't serve equality or $in lookups, which batched lookups and server.py's upserts use
+    collection.create_index("md5")
+    collection.create_index("vision_tags")
+    screenshotcollection.create_index([("md5", pymongo.TEXT)], name="md5_index", unique=True)
+    screenshotcollection.create_index("md5")
+    videocollection.create_index("content_md5")
+    videocollection.create_index("packet_md5")
+    videocollection.create_index("vision_tags")
 
-def push(key, value):
-    REDIS_CLIENT.rpush(key, value)
+
+def field_flag(field, flag):
+    # flag if the field exists on the document, same as {"$exists": True}
+    return {"$cond": [{"$ne": [{"$type": "$" + field}, "missing"]}, flag, 0]}
+
+
+def image_flags(match):
+    # md5 of each matching image doc, with a bitmask of which models it already has
+    return collection.aggregate([
+        {"$match": match},
+        {"$project": {"_id": 0, "md5": 1, "flags": {"$add": [
+            FLAG_PRESENT,
+            field_flag("deepbtags", FLAG_DEEPB),
+            field_flag("vision_tags", FLAG_VISION),
+            field_flag("explicit_detection", FLAG_EXPLICIT),
+        ]}}},
+    ], batchSize=MD5_BATCH_SIZE)
+
+
+def load_md5s():
+    global allmd5s, videomd5s, deepbmd5s, visionmd5s, explicitmd5s
+    logger.info("Loading md5s from MongoDB")
+    start = time.time()
+    # one pass over the image collection
+    imageindex = MD5Index.build(((x.get("md5"), x["flags"]) for x in image_flags({})), flagged=True)
+    allmd5s = imageindex.view(FLAG_PRESENT)
+    deepbmd5s = imageindex.view(FLAG_DEEPB)
+    visionmd5s = imageindex.view(FLAG_VISION)
+    explicitmd5s = imageindex.view(FLAG_EXPLICIT)
+    # possibly because of entryies with no content md5?
+    # both identifiers are loaded so dedupe keeps working while collections move to packet hashes
+    videomd5s = MD5Index.build(video_md5s(videocollection.find(
+        {"$or": [{"content_md5": {"$exists": True}}, {"packet_md5": {"$exists": True}}]},
+        {"content_md5": 1, "packet_md5": 1, "_id": 0}, batch_size=MD5_BATCH_SIZE)))
+    logger.info("Loaded md5s from MongoDB in %.1fs: %s images, %s videos, %.1f MB", time.time() - start,
+                len(imageindex), len(videomd5s), (imageindex.nbytes() + videomd5s.nbytes()) / 1e6)
+
+
+def setup_batch_lookup():
+    # nothing is preloaded; each batch of hashed files is looked up with lookup_batch() instead
+    global allmd5s, videomd5s, deepbmd5s, visionmd5s, explicitmd5s, imagelayers, videolayers
+    imagelayers, videolayers = LayeredMD5Index(), LayeredMD5Index()
+    allmd5s = imagelayers.view(FLAG_PRESENT)
+    deepbmd5s = imagelayers.view(FLAG_DEEPB)
+    visionmd5s = imagelayers.view(FLAG_VISION)
+    explicitmd5s = imagelayers.view(FLAG_EXPLICIT)
+    videomd5s = videolayers
+
+
+def lookup_batch(items):
+    # one projected query per collection for the whole batch; the top layers keep what this run has queued
+    global lookupqueries, lookuptime
+    start = time.time()
+    imagemd5s = list({item[4] for item in items if item[0] == "image"})
+    videomd5list = list({item[4] for item in items if item[0] == "video"})
+    imagelayers.bottom = MD5Index()
+    videolayers.bottom = MD5Index()
+    if imagemd5s:
+        imagelayers.bottom = MD5Index.build(
+            ((x.get("md5"), x["flags"]) for x in image_flags({"md5": {"$in": imagemd5s}})), flagged=True)
+        lookupqueries += 1
+    if videomd5list:
+        videolayers.bottom = MD5Index.build(video_md5s(videocollection.find(
+            {"$or": [{"content_md5": {"$in": videomd5list}}, {"packet_md5": {"$in": videomd5list}}]},
+            {"content_md5": 1, "packet_md5": 1, "_id": 0})))
+        lookupqueries += 1
+    lookuptime += time.time() - start
+
+
+def video_md5s(documents):
+    for x in documents:
+        for field in ("content_md5", "packet_md5"):
+            if isinstance(x.get(field), list):
+                yield from x[field]
+            elif x.get(field) is not None:
+                yield x[field]
+
+
+def push(job):
+    pusher.push(job)
 
 
 def pull(key):
     return REDIS_CLIENT.blpop(key)
 
 
-def process_image_folder(workingdir, is_screenshot, subdiv):
-    global imagecount, imagecount_lock, queuedimagecount, queuedimagecount_lock
-    workingimages = listimages(workingdir, config.process_images)
-    process_models = []
-    # "Process only new" loop here
-    if config.process_only_new:
-        for imagepath in workingimages:
-            with imagecount_lock: imagecount += 1
-            process_models = []
-            im_md5 = get_image_md5(imagepath)
-            if im_md5 not in allmd5s:
-                if subdiv in config.deepbdivs: process_models.append("deepb"), deepbmd5s.add(im_md5)
-                if "vision" in config.configmodels: process_models.append("vision"), visionmd5s.add(im_md5)
-                if process_models:
-                    push("queue", json.dumps({"type": 'image', "path": imagepath, "is_screenshot": is_screenshot,
-                                              "subdiv": subdiv, "models": process_models}))
-                with queuedimagecount_lock: queuedimagecount += 1
-            print(f"Processed {imagecount} images with {queuedimagecount} new ", end="\r")
-        # "Process all" loop here
-    elif not config.process_only_new:
-        for imagepath in workingimages:
-            with imagecount_lock: imagecount += 1
-            process_models = []
-            im_md5 = get_image_md5(imagepath)
-            if "vision" in config.configmodels and im_md5 not in visionmd5s: process_models.append("vision"), visionmd5s.add(im_md5)
-            if "vision" in config.configmodels and im_md5 not in explicitmd5s: process_models.append("explicit"), explicitmd5s.add(im_md5)
-            if subdiv in config.deepbdivs and im_md5 not in deepbmd5s: process_models.append("deepb"), deepbmd5s.add(im_md5)
-            if process_models is not None:
-                push("queue", json.dumps({"type": 'image', "path": imagepath, "is_screenshot": is_screenshot,
-                                          "subdiv": subdiv, "models": process_models}))
-                with queuedimagecount_lock: queuedimagecount += 1
-            print(f"Processed {imagecount} images with {queuedimagecount} new ", end="\r")
-
-
-def process_video_folder(workingdir, subdiv):
-    rootdir = config.getdiv(subdiv)
-    global videocount, videocount_lock, queuedvideocount, queuedvideocount_lock
-    workingvideos = listvideos(workingdir, config.process_videos)
-    # Process only new video loop here
+def hash_fields(md5, stat):
+    # lets server.py skip rehashing when the file's size and mtime still match what was hashed; a file that couldn't
+    # be hashed here is left for the server to try again
+    if stat is None or md5 == "corrupt":
+        return {}
+    return {"md5": md5, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def process_image(imagepath, is_screenshot, subdiv, im_md5, stat=None):
+    # runs on the consumer thread only, so the md5 sets and counters need no locks
+    global imagecount, queuedimagecount
+    imagecount += 1
+    # "Process only new" here
     if config.process_only_new:
-        for videopath in workingvideos:
-            process_models = []
-            with videocount_lock: videocount += 1
-            vid_md5 = get_video_content_md5(videopath)
-            if vid_md5 not in videomd5s:
-                if "vision" in config.configmodels: process_models.append("vision"), videomd5s.add(vid_md5)
+        process_models = []
+        if im_md5 not in allmd5s:
+            if subdiv in config.deepbdivs: process_models.append("deepb"), deepbmd5s.add(im_md5)
+            if "vision" in config.configmodels: process_models.append("vision"), visionmd5s.add(im_md5)
             if process_models:
-                with queuedvideocount_lock: queuedvideocount += 1
-                push("queue", json.dumps({"type": 'video', "path": videopath, "subdiv": subdiv, "models": process_models}))
-            print(f'Processed {videocount} videos with {queuedvideocount} new', end="\r")
-    # Process all videos loop here
-    elif not config.process_only_new:
-        for videopath in workingvideos:
-            process_models = []
-            with videocount_lock: videocount += 1
-            vid_md5 = get_video_content_md5(videopath)
-            if "vision" in config.configmodels and vid_md5 not in visionmd5s: process_models.append("vision"), visionmd5s.add(vid_md5)
-            if "vision" in config.configmodels and vid_md5 not in explicitmd5s: process_models.append("explicit"), explicitmd5s.add(vid_md5)
-            if subdiv in config.deepbdivs and vid_md5 not in deepbmd5s: process_models.append("deepb"), deepbmd5s.add(vid_md5)
-            if process_models:
-                logger.info("Processing video %s", videopath)
-                push("queue", json.dumps({"type": 'video', "path": videopath, "subdiv": subdiv, "models": process_models}))
-            print(f'Processed {videocount} videos with {queuedvideocount} new', end="\r")
+                push({"type": 'image', "path": imagepath, "is_screenshot": is_screenshot,
+                      "subdiv": subdiv, "models": process_models, **hash_fields(im_md5, stat)})
+            queuedimagecount += 1
+    # "Process all" here
+    else:
+        process_models = []
+        if "vision" in config.configmodels and im_md5 not in visionmd5s: process_models.append("vision"), visionmd5s.add(im_md5)
+        if "vision" in config.configmodels and im_md5 not in explicitmd5s: process_models.append("explicit"), explicitmd5s.add(im_md5)
+        if subdiv in config.deepbdivs and im_md5 not in deepbmd5s: process_models.append("deepb"), deepbmd5s.add(im_md5)
+        if process_models:
+            push({"type": 'image', "path": imagepath, "is_screenshot": is_screenshot,
+                  "subdiv": subdiv, "models": process_models, **hash_fields(im_md5, stat)})
+            queuedimagecount += 1
+    print(f"Processed {imagecount} images with {queuedimagecount} new ", end="\r")
+
+
+def process_video(videopath, subdiv, vid_md5, stat=None):
+    global videocount, queuedvideocount
+    videocount += 1
+    # Process only new video here
+    if config.process_only_new:
+        process_models = []
+        if vid_md5 not in videomd5s:
+            if "vision" in config.configmodels: process_models.append("vision"), videomd5s.add(vid_md5)
+        if process_models:
+            queuedvideocount += 1
+            push({"type": 'video', "path": videopath, "subdiv": subdiv, "models": process_models,
+                  "videohash": config.videohash, **hash_fields(vid_md5, stat)})
+    # Process all videos here
+    else:
+        process_models = []
+        if "vision" in config.configmodels and vid_md5 not in visionmd5s: process_models.append("vision"), visionmd5s.add(vid_md5)
+        if "vision" in config.configmodels and vid_md5 not in explicitmd5s: process_models.append("explicit"), explicitmd5s.add(vid_md5)
+        if subdiv in config.deepbdivs and vid_md5 not in deepbmd5s: process_models.append("deepb"), deepbmd5s.add(vid_md5)
+        if process_models:
+            logger.info("Processing video %s", videopath)
+            push({"type": 'video', "path": videopath, "subdiv": subdiv, "models": process_models,
+                  "videohash": config.videohash, **hash_fields(vid_md5, stat)})
+    print(f'Processed {videocount} videos with {queuedvideocount} new', end="\r")
+
+
+class ScanPipeline:
+    # Directory walkers (threads) -> hashers (processes for images, threads for ffmpeg) -> one consumer.
+    # `inflight` bounds how many files can sit between the walkers and the consumer at any time.
+    def __init__(self, walkers, hashers, journal=None, batchsize=1):
+        self.walkers = walkers
+        self.hashers = hashers
+        self.journal = journal
+        self.batchsize = batchsize
+        self.errors = 0
+        self.errors_lock = threading.Lock()
+        self.results = queue.Queue()
+        self.inflight = threading.BoundedSemaphore(max(hashers * 16, batchsize * 2))
+        self.imagepool = None
+        self.videopool = None
+
+    def run(self, subdivs):
+        # the image hashers decode large images one at a time between them
+        self.imagepool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.hashers, initializer=share_large_decode_lock, initargs=(multiprocessing.Lock(),)
+        )
+        self.videopool = concurrent.futures.ThreadPoolExecutor(max_workers=self.hashers)
+        producer = threading.Thread(target=self.produce, args=[subdivs], name="scan-producer")
+        producer.start()
+        self.consume()
+        producer.join()
+
+    def produce(self, subdivs):
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.walkers) as walkpool:
+                for future in [walkpool.submit(self.walk_div, div) for div in subdivs]:
+                    future.result()
+        except Exception as e:
+            self.count_errors()
+            logger.error("Directory walk failed: %s", e, exc_info=True)
+        finally:
+            # every hash callback has fired once both pools are shut down
+            self.imagepool.shutdown(wait=True)
+            self.videopool.shutdown(wait=True)
+            self.results.put(None)
+
+    def walk_div(self, div):
+        global foldercount, skippedfoldercount
+        is_screenshot = 0
+        for path, kind, stat in scan_media(config.getdiv(div), config.process_images, config.process_videos,
+                                           self.journal):
+            if kind == "folder":
+                with foldercount_lock: foldercount += 1
+                is_screenshot = 1 if path.lower().find("screenshot") != -1 else 0
+            elif kind == "skipped":
+                with foldercount_lock: skippedfoldercount += 1
+            elif kind == "image":
+                self.submit_image(path, is_screenshot, div, stat)
+            else:
+                self.submit_video(path, div, stat)
+
+    def submit_image(self, imagepath, is_screenshot, div, stat):
+        self.inflight.acquire()
+        im_md5 = hashcache.get(imagepath, "image", stat) if hashcache is not None else None
+        if im_md5 is not None:
+            self.results.put(("image", imagepath, is_screenshot, div, im_md5, stat, True))
+            return
+        future = self.imagepool.submit(get_image_pixel_md5, imagepath)
+        future.add_done_callback(lambda f: self.results.put(
+            ("image", imagepath, is_screenshot, div, self.hash_result(f, imagepath), stat, False)))
+
+    def submit_video(self, videopath, div, stat):
+        self.inflight.acquire()
+        future = self.videopool.submit(get_video_md5, videopath, config.videohash)
+        future.add_done_callback(lambda f: self.results.put(
+            ("video", videopath, None, div, self.hash_result(f, videopath), stat, False)))
+
+    def count_errors(self, count=1):
+        # called from the walkers, the hash callbacks and the consumer
+        with self.errors_lock:
+            self.errors += count
+
+    def hash_result(self, future, path):
+        # None for a hash that failed or timed out: the file isn't queued, and the scan counts an error so its folder
+        # isn't recorded in the journal as done
+        try:
+            return future.result()
+        except subprocess.TimeoutExpired:
+            pass
+        except Exception as e:
+            logger.error("Exception hashing %s: %s", path, e, exc_info=True)
+        self.count_errors()
+        return None
+
+    def consume(self):
+        # items are handled in batches of up to batchsize, or whatever has arrived once the queue goes quiet
+        batch = []
+        done = False
+        while not done:
+            try:
+                item = self.results.get(timeout=1.0 if batch else None)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                done = True
+            elif item:
+                batch.append(item)
+            if batch and (done or not item or len(batch) >= self.batchsize):
+                self.handle_batch(batch)
+                batch = []
+
+    def handle_batch(self, batch):
+        try:
+            if config.md5lookup == "batch":
+                lookup_batch(batch)
+        except Exception as e:
+            self.count_errors(len(batch))
+            logger.error("Exception looking up batch of %s files: %s", len(batch), e, exc_info=True)
+            for _ in batch:
+                self.inflight.release()
+            return
+        for kind, path, is_screenshot, div, md5, stat, cached in batch:
+            try:
+                if md5 is None:
+                    logger.warning("Not queueing %s, it couldn't be hashed this scan", path)
+                elif kind == "image":
+                    if not cached and hashcache is not None and md5 != "corrupt":
+                        hashcache.put(path, md5, "image", stat)
+                    process_image(path, is_screenshot, div, md5, stat)
+                else:
+                    process_video(path, div, md5, stat)
+            except Exception as e:
+                self.count_errors()
+                logger.error("Exception queueing %s: %s", path, e, exc_info=True)
+            finally:
+                self.inflight.release()
+
+
+def scan_settings():
+    # a change to any of these invalidates the scan journal
+    return {
+        "divs": {div: config.getdiv(div) for div in config.subdivs},
+        "process_images": config.process_images,
+        "process_videos": config.process_videos,
+        "process_only_new": config.process_only_new,
+        "models": config.configmodels,
+        "deepbdivs": config.deepbdivs,
+        "videohash": config.videohash,
+    }
 
 
 def main():
-    global foldercount
+    global hashcache, pusher
+    parser = argparse.ArgumentParser(description="Scan local folders and queue new media for tagging")
+    parser.add_argument("--full", action="store_true", help="rescan every folder, ignoring the scan journal")
+    args = parser.parse_args()
     start_time = time.time()
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.threads)
-    for div in config.subdivs:
-        rootdir = config.getdiv(div)
-        allfolders = listdirs(rootdir)
-        for _ in allfolders:  # spawn thread per entry here
-            workingdir = allfolders.pop(0)
-            foldercount += 1
-            # TODO: limit number of threads
-            if config.process_images:
-                if workingdir.lower().find("screenshot") != -1:
-                    is_screenshot = 1
-                else:
-                    is_screenshot = 0
-                pool.submit(process_image_folder(workingdir, is_screenshot, div))
-            if config.process_videos:
-                pool.submit(process_video_folder(workingdir, div))
+    create_indexes()
+    if config.md5lookup == "batch":
+        setup_batch_lookup()
+    else:
+        load_md5s()
+    hashcache = open_hash_cache(config.hashcache)
+    pusher = JobPusher(REDIS_CLIENT, "queue", config.pushbatch, config.pushinterval)
+    ffmpeg_pool = configure_ffmpeg_pool(config.ffmpeg_workers, config.ffmpeg_timeout, config.ffmpeg_content_timeout)
+    journal = ScanJournal(config.scanjournal, scan_settings(), full=args.full) if config.scanjournal else None
+    pipeline = ScanPipeline(config.walkers, config.hashers, journal,
+                            config.lookupbatch if config.md5lookup == "batch" else 1)
+    pipeline.run(config.subdivs)
+    try:
+        pusher.close()
+    except Exception as e:
+        pipeline.count_errors()
+        logger.error("Exception pushing the last jobs to Redis: %s", e, exc_info=True)
+    if journal is not None:
+        if pipeline.errors:
+            logger.error("Scan finished with %s errors, not updating the scan journal", pipeline.errors)
+        else:
+            journal.commit()
+        logger.warning("Folders skipped: %s (%s entries), folders rescanned: %s", journal.skipped,
+                       journal.skipped_entries, journal.scanned)
+        journal.close()
 
-    # Wait until all threads exit
-    pool.shutdown(wait=True)
     elapsed_time = time.time() - start_time
     final_time = str(datetime.timedelta(seconds=elapsed_time))
-    logger.warning("All entries processed. Root divs: %s, Folder count: %s, Image count: %s, Video count: %s",
-                   config.subdivs, foldercount, imagecount, videocount)
+    logger.warning("All entries processed. Root divs: %s, Folder count: %s (%s unchanged), Image count: %s, "
+                   "Video count: %s", config.subdivs, foldercount, skippedfoldercount, imagecount, videocount)
     print(queuedimagecount, "images and ", queuedvideocount, "videos queued.")
     print("Processing took ", final_time)
+    logger.warning("Hashing rate: %.1f images/s", imagecount / elapsed_time if elapsed_time else 0)
+    logger.warning("Redis: %s", pusher.stats())
+    if config.md5lookup == "batch":
+        logger.warning("Batched lookups: %s queries in %.1fs (%.1f ms per query), %s md5s queued this run held",
+                       lookupqueries, lookuptime, 1000 * lookuptime / lookupqueries if lookupqueries else 0,
+                       len(imagelayers.top) + len(videolayers.top))
+    ffmpeg_pool.shutdown()
+    logger.warning("ffmpeg: %s", ffmpeg_pool.stats())
+    if hashcache is not None:
+        logger.warning("Hash cache: %s hits, %s misses", hashcache.hits, hashcache.misses)
+        close_hash_cache()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import json
+import socket
 from configparser import ConfigParser
 
 
@@ -10,6 +11,21 @@ class MainConfig:
         self.subdivs = json.loads(self.config.get("properties", "subdivs"))
         self.subdivs = json.loads(self.config.get("properties", "subdivs"))
         self.threads = self.config.getint("properties", "threads")
+        self.walkers = self.config.getint("properties", "walkers", fallback=1)
+        self.hashers = self.config.getint("properties", "hashers", fallback=self.threads)
+        self.videohash = self.config.get("properties", "videohash", fallback="content")
+        self.md5lookup = self.config.get("properties", "md5lookup", fallback="preload")
+        self.lookupbatch = self.config.getint("properties", "lookupbatch", fallback=500)
+        self.pushbatch = self.config.getint("properties", "pushbatch", fallback=500)
+        self.pushinterval = self.config.getfloat("properties", "pushinterval", fallback=0.5)
+        self.jobbatch = self.config.getint("properties", "jobbatch", fallback=16)
+        self.jobwait = self.config.getfloat("properties", "jobwait", fallback=0.2)
+        self.worker = self.config.get("properties", "worker", fallback=socket.gethostname())
+        self.writebatch = self.config.getint("properties", "writebatch", fallback=200)
+        self.writeinterval = self.config.getfloat("properties", "writeinterval", fallback=1.0)
+        self.ffmpeg_workers = self.config.getint("properties", "ffmpeg_workers", fallback=2)
+        self.ffmpeg_timeout = self.config.getint("properties", "ffmpeg_timeout", fallback=600)
+        self.ffmpeg_content_timeout = self.config.getint("properties", "ffmpeg_content_timeout", fallback=14400)
         self.connectstring = self.config.get("storage", "connectionstring")
         self.mongodbname = self.config.get("storage", "mongodbname")
         self.mongocollection = self.config.get("storage", "mongocollection")
@@ -17,16 +33,40 @@ class MainConfig:
         self.mongoscreenshotcollection = self.config.get(
             "storage", "mongoscreenshotcollection"
         )
+        self.hashcache = self.config.get("storage", "hashcache", fallback="hashcache.db")
+        self.scanjournal = self.config.get("storage", "scanjournal", fallback="scanjournal.db")
+        self.mongofailed = self.config.get("storage", "mongofailed", fallback="mongo-failed.jsonl")
+        self.responsecache = self.config.get("storage", "responsecache", fallback="responses.db")
+        self.responsecachesize = self.config.getint("storage", "responsecachesize", fallback=2048)
         self.tags_backend = self.config.get("image-recognition", "backend")
         self.configmodels = json.loads(self.config.get("image-recognition", "models"))
         self.google_credentials = self.config.get(
             "image-recognition", "google-credentials"
         )
         self.google_project = self.config.get("image-recognition", "google-project")
+        self.visionmode = self.config.get("image-recognition", "visionmode", fallback="batch")
+        self.visioninflight = self.config.getint("image-recognition", "visioninflight", fallback=8)
+        self.visionrate = self.config.getfloat("image-recognition", "visionrate", fallback=25.0)
+        self.visionconcurrency = self.config.getint("image-recognition", "visionconcurrency", fallback=16)
+        self.videorate = self.config.getfloat("image-recognition", "videorate", fallback=1.0)
+        self.videoconcurrency = self.config.getint("image-recognition", "videoconcurrency", fallback=4)
+        self.apiretries = self.config.getint("image-recognition", "apiretries", fallback=5)
+        self.visionbatch = self.config.getint("image-recognition", "visionbatch", fallback=16)
+        self.vision_endpoint = self.config.get("image-recognition", "vision-endpoint", fallback="")
+        self.visionmaxside = self.config.getint("image-recognition", "visionmaxside", fallback=2048)
+        self.visionuploadformat = self.config.get("image-recognition", "visionuploadformat", fallback="JPEG")
+        self.visionuploadquality = self.config.getint("image-recognition", "visionuploadquality", fallback=88)
+        self.visionscreenshotfullres = self.config.getboolean(
+            "image-recognition", "visionscreenshotfullres", fallback=True
+        )
         self.deepbmodelpath = self.config.get("deepb", "model")
         self.deepbtagfile = self.config.get("deepb", "tagfile")
         self.deepbthreshold = self.config.getfloat("deepb", "threshold")
         self.deepbdivs = json.loads(self.config.get("deepb", "deepbdivs"))
+        self.deepbbatch = self.config.getint("deepb", "batchsize", fallback=16)
+        self.deepbfastdecode = self.config.getboolean("deepb", "fastdecode", fallback=False)
+        self.deepbprefetch = self.config.getint("deepb", "prefetch", fallback=2)
+        self.deepbdecoders = self.config.getint("deepb", "decoders", fallback=4)
         self.logging_level = self.config.get("logging", "loglevel")  # TODO: use this
         self.process_only_new = self.config.get("flags", "process_only_new")
         self.process_videos = self.config.getboolean("flags", "process_videos")
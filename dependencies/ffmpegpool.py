@@ -0,0 +1,81 @@
+import logging
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FFmpegPool:
+    # Caps how many ffmpeg processes run at once, kills calls that exceed their timeout,
+    # and keeps wall-time stats per call. Arguments are always passed as a list, never through a shell.
+    def __init__(self, max_concurrent=2, timeout=600, binary="ffmpeg"):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.binary = binary
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.running = set()
+        self.closed = False
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def run(self, args, timeout=None):
+        # returns (returncode, stdout, stderr); raises subprocess.TimeoutExpired after killing the process
+        timeout = self.timeout if timeout is None else timeout
+        with self.slots:
+            if self.closed:
+                raise RuntimeError("ffmpeg pool is shut down")
+            start = time.monotonic()
+            process = subprocess.Popen(
+                [self.binary, "-nostdin", "-hide_banner"] + list(args),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            with self.lock:
+                self.running.add(process)
+            try:
+                out, err = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                self.record(time.monotonic() - start, timedout=True)
+                logger.error("ffmpeg timed out after %ss: %s", timeout, args)
+                raise
+            finally:
+                with self.lock:
+                    self.running.discard(process)
+            self.record(time.monotonic() - start, failed=process.returncode != 0)
+            return process.returncode, out, err
+
+    def record(self, elapsed, failed=False, timedout=False):
+        with self.lock:
+            self.calls += 1
+            self.failures += failed
+            self.timeouts += timedout
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "total_time": round(self.total_time, 3),
+                "mean_time": round(self.total_time / self.calls, 3) if self.calls else 0.0,
+                "max_time": round(self.max_time, 3),
+            }
+
+    def shutdown(self):
+        # kill anything still running so a stuck file can't hold up exit
+        with self.lock:
+            self.closed = True
+            running = list(self.running)
+        for process in running:
+            process.kill()
+        logger.info("ffmpeg pool stats: %s", self.stats())
@@ -5,15 +5,51 @@ import os
 import re
 import subprocess
 import sys
+import threading
 
 from PIL import Image
 
+from dependencies.ffmpegpool import FFmpegPool
+from dependencies.hashcache import HashCache
+
 # initialize logger
 logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
 logging.getLogger("PIL").setLevel(logging.ERROR)
 logging.debug("logging started")
 logger = logging.getLogger(__name__)
 
+# shared ffmpeg process pool, sized by the entry point with configure_ffmpeg_pool()
+ffmpeg_pool = FFmpegPool()
+
+# seconds before a content hash, which decodes every frame, is killed; set with configure_ffmpeg_pool()
+content_hash_timeout = 4 * 60 * 60
+
+# shared stat-keyed hash cache, opened by the entry point with open_hash_cache()
+hashcache = None
+
+
+def open_hash_cache(cachepath):
+    global hashcache
+    if hashcache is None and cachepath:
+        hashcache = HashCache(cachepath)
+        logger.info("Using hash cache %s", cachepath)
+    return hashcache
+
+
+def close_hash_cache():
+    global hashcache
+    if hashcache is not None:
+        hashcache.close()
+        hashcache = None
+
+
+def configure_ffmpeg_pool(max_concurrent, timeout, content_timeout=None):
+    global ffmpeg_pool, content_hash_timeout
+    ffmpeg_pool = FFmpegPool(max_concurrent, timeout)
+    if content_timeout is not None:
+        content_hash_timeout = content_timeout
+    return ffmpeg_pool
+
 
 # list all subdirectories in a given folder
 def listdirs(folder):
@@ -52,6 +88,70 @@ def listvideos(subfolder, process_videos):
     return internallist
 
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".gif", ".jpeg", ".webp")
+VIDEO_EXTENSIONS = (".mp4", ".webm", ".mov", ".mkv")
+
+
+def entry_stat(entry):
+    # DirEntry.stat() leaves st_dev and st_ino at 0 on Windows, and the hash cache keys on them like os.stat() does
+    return os.stat(entry.path) if os.name == "nt" else entry.stat()
+
+
+# walk a folder once with os.scandir, yielding (path, kind, stat) as entries are found
+# kind is "folder" for each directory (before its files), then "image" or "video"
+# with a ScanJournal, folders unchanged since the last scan are yielded as "skipped" and not listed
+# symlinked folders are followed, each real folder is scanned once
+def scan_media(folder, process_images=True, process_videos=True, journal=None):
+    pending = [(folder, os.stat(folder))]
+    seen = set()
+    while pending:
+        directory, dirstat = pending.pop()
+        if dirstat.st_ino:
+            if (dirstat.st_dev, dirstat.st_ino) in seen:
+                continue
+            seen.add((dirstat.st_dev, dirstat.st_ino))
+        subdirnames = journal.unchanged(directory, dirstat) if journal is not None else None
+        if subdirnames is not None:
+            yield directory, "skipped", dirstat
+            subdirs = []
+            for name in subdirnames:
+                try:
+                    subdirs.append((os.path.join(directory, name), os.stat(os.path.join(directory, name))))
+                except OSError as e:
+                    logger.warning("Could not stat folder %s: %s", name, e)
+            pending.extend(reversed(sorted(subdirs)))
+            continue
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            logger.warning("Could not scan folder %s: %s", directory, e)
+            continue
+        yield directory, "folder", dirstat
+        subdirs = []
+        entrycount = 0
+        with entries:
+            for entry in entries:
+                entrycount += 1
+                try:
+                    if entry.is_dir():
+                        if not entry.name.startswith("."):
+                            subdirs.append((entry.path, entry_stat(entry)))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    name = entry.name.lower()
+                    if process_images and name.endswith(IMAGE_EXTENSIONS):
+                        yield entry.path, "image", entry_stat(entry)
+                    elif process_videos and name.endswith(VIDEO_EXTENSIONS):
+                        yield entry.path, "video", entry_stat(entry)
+                except OSError as e:
+                    logger.warning("Could not stat %s: %s", entry.path, e)
+        if journal is not None:
+            journal.record(directory, dirstat, entrycount, sorted(os.path.basename(path) for path, _ in subdirs))
+        # reversed so folders come off the stack in name order, like os.walk
+        pending.extend(reversed(sorted(subdirs)))
+
+
 # open an image at a given path
 def get_image_content(image_path):
     with io.open(image_path, "rb") as image:
@@ -64,47 +164,102 @@ def get_video_content(video_path):
         return video.read()
 
 
-def get_image_md5(image_path):
+def get_image_md5(image_path, stat=None, hasher=None):
+    # hasher computes the digest on a cache miss, get_image_pixel_md5(image_path) by default
+    if hashcache is not None:
+        md5 = hashcache.get(image_path, "image", stat)
+        if md5 is not None:
+            return md5
+    md5 = hasher() if hasher is not None else get_image_pixel_md5(image_path)
+    if hashcache is not None and md5 != "corrupt":
+        hashcache.put(image_path, md5, "image", stat)
+    return md5
+
+
+# images above this many pixels aren't kept decoded by media.ImageMedia, they're hashed and dropped
+LARGE_IMAGE_PIXELS = 64 * 1024 * 1024
+# approximate size of one row band passed to the hash
+HASH_BAND_BYTES = 32 * 1024 * 1024
+
+# held while a large image is decoded, so only one is in memory at a time; per process unless a process pool shares
+# one through share_large_decode_lock()
+large_decode_lock = threading.Lock()
+
+
+def share_large_decode_lock(lock):
+    # ProcessPoolExecutor initializer, with a multiprocessing.Lock shared by every process in the pool
+    global large_decode_lock
+    large_decode_lock = lock
+
+
+def get_image_pixel_md5(image_path):
+    # Produces the same digest as hashlib.md5(im.tobytes()) without copying the whole raster out as bytes, so peak
+    # memory is the raster plus one band rather than twice the raster. Pillow has no public API for decoding part of
+    # an image, so every format is decoded whole; images over LARGE_IMAGE_PIXELS take turns through
+    # large_decode_lock, so however many hashers run, only one large raster is held at once.
+    # image_path can also be a file object, which is read from the start
     try:
         with Image.open(image_path) as im:
-            return hashlib.md5(im.tobytes()).hexdigest()
+            if im.width * im.height > LARGE_IMAGE_PIXELS:
+                with large_decode_lock:
+                    im.load()
+                    return get_raster_md5(im)
+            im.load()
+            return get_raster_md5(im)
     except OSError:
         return "corrupt"
     except SyntaxError:
         return "corrupt"
 
 
+def get_raster_md5(im):
+    # digest of a decoded image, fed to the hash in row bands; tobytes() packs each row on its own, so the bands
+    # concatenate to exactly im.tobytes()
+    md5 = hashlib.md5()
+    bandrows = max(1, HASH_BAND_BYTES // max(1, im.width * 4))
+    if im.height <= bandrows:
+        md5.update(im.tobytes())
+        return md5.hexdigest()
+    for top in range(0, im.height, bandrows):
+        md5.update(im.crop((0, top, im.width, min(im.height, top + bandrows))).tobytes())
+    return md5.hexdigest()
+
+
+def get_video_md5(video_path, videohash="content"):
+    # "content" hashes every decoded frame, "packet" hashes the compressed video stream without decoding
+    if videohash == "packet":
+        return get_video_packet_md5(video_path)
+    return get_video_content_md5(video_path)
+
+
 def get_video_content_md5(video_path):
+    return _ffmpeg_md5(video_path, ["-map", "0:v"], content_hash_timeout)
+
+
+def get_video_packet_md5(video_path):
+    return _ffmpeg_md5(video_path, ["-map", "0:v", "-c", "copy"])
+
+
+def _ffmpeg_md5(video_path, ffmpeg_args, timeout=None):
+    # "corrupt" for a file ffmpeg can't hash; a timeout says nothing about the file, so it raises
+    # subprocess.TimeoutExpired instead and the caller can try again later
     try:
-        if os.name == "nt":
-            process = subprocess.Popen(
-                'cmd /c ffmpeg.exe -i "{vpath}" -map 0:v -f md5 -'.format(
-                    vpath=video_path
-                ),
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-        else:
-            process = subprocess.Popen(
-                'ffmpeg -i "{vpath}" -map 0:v -f md5 -'.format(vpath=video_path),
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-        out, err = process.communicate()
+        returncode, out, err = ffmpeg_pool.run(["-i", video_path] + ffmpeg_args + ["-f", "md5", "-"], timeout)
         md5list = re.findall(r"MD5=([a-fA-F\d]{32})", str(out))
-        logger.info("Got content MD5 for video %s: %s", video_path, md5list)
+        logger.info("Got MD5 for video %s (%s): %s", video_path, " ".join(ffmpeg_args), md5list)
         try:
             md5 = md5list[0]
         except IndexError:
             md5 = "corrupt"
             logger.error(
-                "Exception getting MD5 for path %s with ffmpeg: %s",
+                "Exception getting MD5 for path %s with ffmpeg (exit code %s): %s",
                 video_path,
+                returncode,
                 err,
-                exc_info=True,
             )
+    except subprocess.TimeoutExpired:
+        logger.error("Timed out getting MD5 for path %s with ffmpeg", video_path)
+        raise
     except Exception as e:
         logger.error(
             "Unhandled exception getting MD5 for path %s with ffmpeg: %s",
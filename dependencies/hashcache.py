@@ -0,0 +1,83 @@
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class HashCache:
+    # Persistent map of file stat -> hash, so unchanged files aren't decoded again on every scan.
+    # Rows are keyed by (device, inode, size, mtime_ns, path); any change to the file invalidates its row.
+    def __init__(self, cachepath, commit_every=500):
+        self.cachepath = cachepath
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cachepath, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT NOT NULL, kind TEXT NOT NULL, dev INTEGER NOT NULL, ino INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, md5 TEXT NOT NULL, "
+            "PRIMARY KEY (path, kind))"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def statkey(path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, kind="image", stat=None):
+        try:
+            key = self.statkey(path, stat)
+        except OSError:
+            return None
+        with self.lock:
+            if self.db is None:
+                return None
+            row = self.db.execute(
+                "SELECT md5 FROM hashes WHERE path = ? AND kind = ? AND dev = ? AND ino = ? AND size = ? "
+                "AND mtime_ns = ?",
+                (path, kind) + key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, path, md5, kind="image", stat=None):
+        try:
+            key = self.statkey(path, stat)
+        except OSError:
+            return
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.execute(
+                "INSERT OR REPLACE INTO hashes (path, kind, dev, ino, size, mtime_ns, md5) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, kind) + key + (md5,),
+            )
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.commit()
+            self.db.close()
+            self.db = None
+        logger.info("Closed hash cache %s (%s hits, %s misses)", self.cachepath, self.hits, self.misses)
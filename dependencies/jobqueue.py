@@ -0,0 +1,240 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class JobPusher:
+    # Buffers jobs and pushes them to a Redis list in batches through a pipeline, flushing when
+    # `batchsize` jobs are waiting or the oldest has waited `interval` seconds. Call close() to flush the rest.
+    # A failed flush keeps its jobs buffered for the next one; close() raises if any background flush failed, since
+    # jobs from a pipeline that failed partway may have been pushed twice or, if the last flush fails too, not at all.
+    def __init__(self, redis_client, key="queue", batchsize=500, interval=0.5):
+        self.redis = redis_client
+        self.key = key
+        self.batchsize = batchsize
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.oldest = None
+        self.pushed = 0
+        self.flushes = 0
+        self.push_time = 0.0
+        self.failed_flushes = 0
+        self.error = None
+        self.started = time.monotonic()
+        self.stopping = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_stale, name="job-pusher", daemon=True)
+        self.flusher.start()
+
+    def push(self, job):
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.append(json.dumps(job))
+            if len(self.buffer) >= self.batchsize:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        start = time.monotonic()
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(self.buffer), self.batchsize):
+            pipe.rpush(self.key, *self.buffer[i:i + self.batchsize])
+        pipe.execute()
+        self.push_time += time.monotonic() - start
+        self.pushed += len(self.buffer)
+        self.flushes += 1
+        self.buffer = []
+        self.oldest = None
+
+    def flush_stale(self):
+        while not self.stopping.wait(self.interval / 2):
+            try:
+                with self.lock:
+                    if self.oldest is not None and time.monotonic() - self.oldest >= self.interval:
+                        self._flush()
+            except Exception as e:
+                self.failed_flushes += 1
+                self.error = e
+                logger.error("Exception pushing jobs to Redis: %s", e, exc_info=True)
+
+    def close(self):
+        self.stopping.set()
+        self.flusher.join()
+        self.flush()
+        stats = self.stats()
+        logger.info("Pushed %s jobs in %s flushes, %.1f jobs/s", stats["pushed"], stats["flushes"],
+                    stats["jobs_per_second"])
+        if self.error is not None:
+            raise RuntimeError(f"{self.failed_flushes} background pushes to Redis failed") from self.error
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "pushed": self.pushed,
+            "flushes": self.flushes,
+            "push_time": round(self.push_time, 3),
+            "failed_flushes": self.failed_flushes,
+            "jobs_per_second": self.pushed / elapsed if elapsed else 0.0,
+        }
+
+
+# Moves up to ARGV[1] jobs from the head of KEYS[1] onto the tail of KEYS[2] in one step, so a job is always on one of
+# the two lists. Scripts run atomically, so concurrent workers never get the same job (works before Redis 6.2's LMOVE).
+MOVE_JOBS = """
+local jobs = redis.call("LRANGE", KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #jobs > 0 then
+    redis.call("LTRIM", KEYS[1], #jobs, -1)
+    redis.call("RPUSH", KEYS[2], unpack(jobs))
+end
+return jobs
+"""
+
+# Puts everything on KEYS[1] back at the head of KEYS[2], in its original order
+REQUEUE_JOBS = """
+local jobs = redis.call("LRANGE", KEYS[1], 0, -1)
+for i = #jobs, 1, -1 do
+    redis.call("LPUSH", KEYS[2], jobs[i])
+end
+redis.call("DEL", KEYS[1])
+return #jobs
+"""
+
+
+def pull_batch(redis_client, key="queue", maxjobs=16, maxwait=0.2, processing=None, timeout=0):
+    # Blocks for the first job, then takes up to maxjobs - 1 more, waiting at most maxwait seconds for them.
+    # timeout bounds the wait for the first job (0 waits forever) and an empty list is returned when it runs out.
+    # With a processing list, jobs are moved onto it as they're taken and stay there until ack_jobs(), so
+    # requeue_jobs() can put back whatever a worker took and never finished.
+    jobs = _take_jobs(redis_client, key, maxjobs, processing)
+    if not jobs:
+        job = _wait_job(redis_client, key, timeout, processing)
+        if job is None:
+            return []
+        jobs = [job]
+    deadline = time.monotonic() + maxwait
+    while len(jobs) < maxjobs:
+        more = _take_jobs(redis_client, key, maxjobs - len(jobs), processing)
+        if more:
+            jobs.extend(more)
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        job = _wait_job(redis_client, key, remaining, processing)
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def _take_jobs(redis_client, key, count, processing):
+    if processing is not None:
+        return redis_client.register_script(MOVE_JOBS)(keys=[key, processing], args=[count])
+    # LRANGE + LTRIM in one MULTI, so concurrent workers never get the same job (works before Redis 6.2)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.lrange(key, 0, count - 1)
+    pipe.ltrim(key, count, -1)
+    jobs, _ = pipe.execute()
+    return jobs
+
+
+def _wait_job(redis_client, key, timeout, processing):
+    if processing is not None:
+        # only called on an empty list, so this is the first push to arrive (its last job, if it pushed several)
+        return redis_client.brpoplpush(key, processing, timeout)
+    item = redis_client.blpop(key, timeout=timeout)
+    return None if item is None else item[1]
+
+
+def ack_jobs(redis_client, processing, jobs):
+    # takes finished jobs off the processing list they were pulled onto
+    if not jobs:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for job in jobs:
+        pipe.lrem(processing, 1, job)
+    pipe.execute()
+
+
+def requeue_jobs(redis_client, key, processing):
+    # puts jobs pulled but never acked back at the head of the queue; returns how many
+    return redis_client.register_script(REQUEUE_JOBS)(keys=[processing, key])
+
+
+class BatchPrefetcher:
+    # Pulls job batches on a background thread and runs prepare() on each (e.g. decoding its images), keeping
+    # up to `depth` prepared batches ready so the consumer doesn't wait on either. next() returns (jobs, prepared),
+    # with prepared None if prepare() failed. Jobs held here are already off the queue, so pull() should move them
+    # onto a processing list (see pull_batch) to be requeued if the worker stops. pull() may return an empty list
+    # when nothing arrived in time, which lets close() stop the thread.
+    def __init__(self, pull, prepare, depth=2):
+        self.pull = pull
+        self.prepare = prepare
+        self.ready = queue.Queue(maxsize=max(depth, 1))
+        self.batches = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.prepare_time = 0.0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.fill, name="batch-prefetch", daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        while not self.stopping.is_set():
+            try:
+                jobs = self.pull()
+            except Exception as e:
+                logger.error("Exception pulling jobs: %s", e, exc_info=True)
+                time.sleep(1)
+                continue
+            if not jobs:
+                continue
+            start = time.monotonic()
+            try:
+                prepared = self.prepare(jobs)
+            except Exception as e:
+                logger.error("Exception preparing job batch: %s", e, exc_info=True)
+                prepared = None
+            self.prepare_time += time.monotonic() - start
+            while not self.stopping.is_set():
+                try:
+                    self.ready.put((jobs, prepared), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def next(self):
+        try:
+            item = self.ready.get_nowait()
+        except queue.Empty:
+            # the consumer caught up with the prefetcher, count how long it sat idle
+            start = time.monotonic()
+            item = self.ready.get()
+            self.waits += 1
+            self.wait_time += time.monotonic() - start
+        self.batches += 1
+        return item
+
+    def close(self, timeout=10):
+        # stops pulling; batches still held are dropped here and have to be requeued from the processing list
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "ready": self.ready.qsize(),
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 3),
+            "prepare_time": round(self.prepare_time, 3),
+        }
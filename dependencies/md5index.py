@@ -0,0 +1,175 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(md5):
+    try:
+        digest = bytes.fromhex(md5)
+    except (TypeError, ValueError):
+        return None
+    return digest if len(digest) == 16 else None
+
+
+def _decode_chunk(chunk, chunkflags, buffer, flagbuffer, extra):
+    # one fromhex call per chunk, falling back to one per entry if the chunk has a non-hex value in it
+    try:
+        buffer += bytes.fromhex("".join(chunk))
+        flagbuffer += bytes(chunkflags)
+    except ValueError:
+        for md5, flags in zip(chunk, chunkflags):
+            digest = _digest(md5)
+            if digest is None:
+                extra[md5] = extra.get(md5, 0) | flags
+            else:
+                buffer += digest
+                flagbuffer.append(flags)
+
+
+def _sorted_unique(buffer, flagbuffer):
+    # sorting the digests as big-endian (high, low) uint64 pairs gives the same order as comparing the
+    # 16 bytes, and is several times faster than np.unique on an "S16" array
+    pairs = np.frombuffer(buffer, dtype=">u8").reshape(-1, 2)
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    pairs = pairs[order]
+    flags = np.frombuffer(flagbuffer, dtype=np.uint8)[order]
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = (pairs[1:] != pairs[:-1]).any(axis=1)
+    if len(pairs):
+        # duplicates keep the union of their flags
+        flags = np.bitwise_or.reduceat(flags, np.flatnonzero(first))
+    return np.ascontiguousarray(pairs[first]).view("S16").reshape(-1), flags
+
+
+class MD5Index:
+    # Set-like membership index of hex MD5s, stored as a sorted array of 16-byte digests (16 bytes per entry,
+    # against ~100 for a set of str), with one byte of per-model flags alongside each digest.
+    # Entries added after building, and non-hex values such as "corrupt", go to a small dict on the side.
+    def __init__(self, digests=None, flags=None):
+        self.digests = np.empty(0, dtype="S16") if digests is None else digests
+        self.flags = np.zeros(len(self.digests), dtype=np.uint8) if flags is None else flags
+        self.extra = {}
+
+    @classmethod
+    def build(cls, md5s, flagged=False):
+        # md5s yields hex strings, or (hex string, flags) pairs when flagged is set
+        buffer, flagbuffer = bytearray(), bytearray()
+        extra = {}
+        chunk, chunkflags = [], []
+        for item in md5s:
+            md5, flags = item if flagged else (item, 0)
+            if isinstance(md5, str) and len(md5) == 32:
+                chunk.append(md5)
+                chunkflags.append(flags)
+                if len(chunk) >= 65536:
+                    _decode_chunk(chunk, chunkflags, buffer, flagbuffer, extra)
+                    chunk, chunkflags = [], []
+            else:
+                extra[md5] = extra.get(md5, 0) | flags
+        _decode_chunk(chunk, chunkflags, buffer, flagbuffer, extra)
+        index = cls(*_sorted_unique(buffer, flagbuffer))
+        index.extra = extra
+        return index
+
+    def _position(self, md5):
+        digest = _digest(md5)
+        if digest is None:
+            return None
+        position = np.searchsorted(self.digests, digest)
+        # numpy drops trailing NUL bytes from "S" elements, so compare the same way
+        if position < len(self.digests) and self.digests[position] == digest.rstrip(b"\0"):
+            return position
+        return None
+
+    def has(self, md5, flag=0):
+        # flag=0 tests plain membership, otherwise whether any of the flag bits are set for md5
+        position = self._position(md5)
+        if position is not None:
+            return flag == 0 or bool(self.flags[position] & flag)
+        if md5 in self.extra:
+            return flag == 0 or bool(self.extra[md5] & flag)
+        return False
+
+    def __contains__(self, md5):
+        return self.has(md5)
+
+    def contains_many(self, md5s, flag=0):
+        # vectorized lookup, returns a bool array in the order of md5s
+        md5s = list(md5s)
+        digests = [_digest(md5) for md5 in md5s]
+        keys = np.array([digest or b"" for digest in digests], dtype="S16")
+        if len(self.digests):
+            positions = np.minimum(np.searchsorted(self.digests, keys), len(self.digests) - 1)
+            found = self.digests[positions] == keys
+            if flag:
+                found &= (self.flags[positions] & flag) != 0
+        else:
+            found = np.zeros(len(keys), dtype=bool)
+        for i, md5 in enumerate(md5s):
+            if digests[i] is None or (not found[i] and md5 in self.extra):
+                found[i] = self.has(md5, flag)
+        return found
+
+    def add(self, md5, flag=0):
+        position = self._position(md5)
+        if position is not None:
+            self.flags[position] |= flag
+        else:
+            self.extra[md5] = self.extra.get(md5, 0) | flag
+
+    def view(self, flag):
+        return MD5IndexView(self, flag)
+
+    def __len__(self):
+        return len(self.digests) + len(self.extra)
+
+    def nbytes(self):
+        return self.digests.nbytes + self.flags.nbytes
+
+
+class MD5IndexView:
+    # set-like view of the md5s in an MD5Index that have a given flag
+    def __init__(self, index, flag):
+        self.index = index
+        self.flag = flag
+
+    def __contains__(self, md5):
+        return self.index.has(md5, self.flag)
+
+    def contains_many(self, md5s):
+        return self.index.contains_many(md5s, self.flag)
+
+    def add(self, md5):
+        self.index.add(md5, self.flag)
+
+
+class LayeredMD5Index:
+    # lookups see both layers, additions only go to the top one; used by client.py's batched lookup mode,
+    # where the bottom layer is replaced with each batch's query results
+    def __init__(self, top=None, bottom=None):
+        self.top = MD5Index() if top is None else top
+        self.bottom = MD5Index() if bottom is None else bottom
+
+    def has(self, md5, flag=0):
+        return self.top.has(md5, flag) or self.bottom.has(md5, flag)
+
+    def __contains__(self, md5):
+        return self.has(md5)
+
+    def contains_many(self, md5s, flag=0):
+        md5s = list(md5s)
+        return self.top.contains_many(md5s, flag) | self.bottom.contains_many(md5s, flag)
+
+    def add(self, md5, flag=0):
+        self.top.add(md5, flag)
+
+    def view(self, flag):
+        return MD5IndexView(self, flag)
+
+    def __len__(self):
+        return len(self.top) + len(self.bottom)
+
+    def nbytes(self):
+        return self.top.nbytes() + self.bottom.nbytes()
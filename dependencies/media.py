@@ -0,0 +1,88 @@
+import io
+import logging
+
+from PIL import Image
+
+from dependencies.fileops import LARGE_IMAGE_PIXELS, get_image_md5, get_image_pixel_md5, get_raster_md5
+
+logger = logging.getLogger(__name__)
+
+
+class ImageMedia:
+    # One image job's file: read once, with the bytes shared between hashing, deepb preprocessing and the
+    # Vision upload. The decoded raster is kept until release(), so the pixel hash, deepb and the upload use the
+    # same decode. Images over LARGE_IMAGE_PIXELS are never kept; each use decodes them and drops the raster.
+    def __init__(self, path, stat=None, md5=None):
+        # md5 is a hash already known to match the file, e.g. the one client.py sent with the job
+        self.path = path
+        self.stat = stat
+        self._content = None
+        self._image = None
+        self._md5 = md5
+        self.trusted_md5 = md5 is not None
+        self._upload = None
+        self._large = None
+        self.reads = 0
+        self.decodes = 0
+
+    def content(self):
+        if self._content is None:
+            with open(self.path, "rb") as file:
+                self._content = file.read()
+            self.reads += 1
+        return self._content
+
+    def image(self):
+        if self._image is None:
+            image = Image.open(io.BytesIO(self.content()))
+            image.load()
+            self.decodes += 1
+            self._image = image
+        return self._image
+
+    def md5(self):
+        if self._md5 is None:
+            self._md5 = get_image_md5(self.path, self.stat, self.pixel_md5)
+        return self._md5
+
+    def large(self):
+        # from the header, without decoding
+        if self._large is None:
+            with Image.open(io.BytesIO(self.content())) as im:
+                self._large = im.width * im.height > LARGE_IMAGE_PIXELS
+        return self._large
+
+    def pixel_md5(self):
+        try:
+            if self.large():
+                self.decodes += 1
+                return get_image_pixel_md5(io.BytesIO(self.content()))
+            return get_raster_md5(self.image())
+        except (OSError, SyntaxError):
+            return "corrupt"
+
+    def deepb_input(self, model):
+        # At full scale the kept raster is used, decoding it here if hashing didn't, so the upload can reuse it too.
+        # With fast_decode the bytes are decoded again at reduced scale, as load_image does.
+        if not model.fast_decode and not self.large():
+            return model.prepare_image(self.image())
+        self.decodes += 1
+        return model.load_image(io.BytesIO(self.content()))
+
+    def vision_content(self, preprocessor=None, is_screenshot=False):
+        # the bytes to send to Vision, shrunk by a visionupload.UploadPreprocessor from the raster if it's decoded
+        if preprocessor is None:
+            return self.content()
+        if self._upload is None:
+            self._upload, decoded = preprocessor.shrink(self.content(), is_screenshot, self._image)
+            self.decodes += decoded
+        return self._upload
+
+    def release(self):
+        # drops the raster, keeping the bytes, the upload and the hash
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+    def stats(self):
+        return {"reads": self.reads, "decodes": self.decodes, "bytes": len(self._content or b"")}
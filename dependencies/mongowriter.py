@@ -0,0 +1,172 @@
+import logging
+import os
+import threading
+import time
+
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+logger = logging.getLogger(__name__)
+
+# duplicate key: two upserts of the same new document raced, retrying turns the loser into an update
+RETRYABLE_WRITE_CODES = {11000}
+
+
+class BulkWriter:
+    # Write-behind buffer for MongoDB. Queued update_one upserts go out as unordered bulk_write calls per
+    # collection, once `batchsize` are waiting or the oldest has waited `interval` seconds. Operations must be
+    # idempotent ($set, $setOnInsert, $addToSet), since batches are retried after connection errors.
+    # Writes that still fail are appended to `failedpath` and replayed by replay_failed(). Call close() to flush.
+    def __init__(self, database, batchsize=200, interval=1.0, failedpath=None, retries=3):
+        self.database = database
+        self.batchsize = batchsize
+        self.interval = interval
+        self.failedpath = failedpath
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.buffer = {}
+        self.queued = 0
+        self.oldest = None
+        self.written = 0
+        self.flushes = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.write_time = 0.0
+        self.slowest_write = 0.0
+        self.retried = 0
+        self.failed = 0
+        self.stopping = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_stale, name="mongo-writer", daemon=True)
+        self.flusher.start()
+
+    def update(self, collection, filter, update, upsert=True):
+        with self.lock:
+            if not self.queued:
+                self.oldest = time.monotonic()
+            self.buffer.setdefault(collection.name, []).append((filter, update, upsert))
+            self.queued += 1
+            if self.queued >= self.batchsize:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.queued:
+            return
+        buffer, self.buffer = self.buffer, {}
+        self.queued = 0
+        self.oldest = None
+        self.flushes += 1
+        for name, ops in buffer.items():
+            self._write(name, ops)
+
+    def _write(self, name, ops):
+        attempt = 0
+        while ops:
+            start = time.monotonic()
+            try:
+                self.database[name].bulk_write(
+                    [UpdateOne(filter, update, upsert=upsert) for filter, update, upsert in ops], ordered=False
+                )
+                failed = []
+            except BulkWriteError as e:
+                # unordered, so everything not listed in writeErrors went through
+                errors = e.details.get("writeErrors", [])
+                failed = [(ops[error["index"]], error) for error in errors]
+                for error in e.details.get("writeConcernErrors", []):
+                    logger.warning("Write concern error writing to %s: %s", name, error.get("errmsg"))
+            except ConnectionFailure as e:
+                # covers timeouts and lost connections; the whole batch is retried, upserts make that safe
+                failed = [(op, {"errmsg": str(e), "retry": True}) for op in ops]
+            except Exception as e:
+                failed = [(op, {"errmsg": str(e)}) for op in ops]
+            self.record(len(ops) - len(failed), time.monotonic() - start)
+            attempt += 1
+            retry, give_up = [], []
+            for op, error in failed:
+                retryable = error.get("retry") or error.get("code") in RETRYABLE_WRITE_CODES
+                if retryable and attempt <= self.retries:
+                    retry.append(op)
+                else:
+                    give_up.append((op, error))
+            if give_up:
+                self.save_failed(name, give_up)
+            if retry:
+                self.retried += len(retry)
+                logger.warning("Retrying %s of %s writes to %s", len(retry), len(ops), name)
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            ops = retry
+
+    def record(self, written, elapsed):
+        self.written += written
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, written)
+        self.write_time += elapsed
+        self.slowest_write = max(self.slowest_write, elapsed)
+
+    def save_failed(self, name, failed):
+        self.failed += len(failed)
+        for (filter, update, upsert), error in failed:
+            logger.error("Failed to write %s to %s: %s", filter, name, error.get("errmsg"))
+        if not self.failedpath:
+            return
+        with open(self.failedpath, "a", encoding="utf-8") as file:
+            for (filter, update, upsert), error in failed:
+                file.write(json_util.dumps({"collection": name, "filter": filter, "update": update,
+                                            "upsert": upsert, "error": error.get("errmsg")}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def replay_failed(self):
+        # queues writes saved by earlier runs again; the ones that fail again are saved again
+        if not self.failedpath:
+            return 0
+        replaypath = self.failedpath + ".replay"
+        # a leftover replay file means the last replay was interrupted, finish that one first
+        if not os.path.exists(replaypath):
+            if not os.path.exists(self.failedpath):
+                return 0
+            os.replace(self.failedpath, replaypath)
+        count = 0
+        with open(replaypath, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    entry = json_util.loads(line)
+                    self.update(self.database[entry["collection"]], entry["filter"], entry["update"], entry["upsert"])
+                    count += 1
+        self.flush()
+        os.remove(replaypath)
+        logger.info("Replayed %s failed MongoDB writes from %s", count, self.failedpath)
+        return count
+
+    def flush_stale(self):
+        while not self.stopping.wait(self.interval / 2):
+            try:
+                with self.lock:
+                    if self.oldest is not None and time.monotonic() - self.oldest >= self.interval:
+                        self._flush()
+            except Exception as e:
+                logger.error("Exception writing to MongoDB: %s", e, exc_info=True)
+
+    def close(self):
+        self.stopping.set()
+        self.flusher.join()
+        self.flush()
+        logger.info("MongoDB writes: %s", self.stats())
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "queued": self.queued,
+            "flushes": self.flushes,
+            "batches": self.batches,
+            "mean_batch": round(self.written / self.batches, 1) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "mean_write_ms": round(self.write_time / self.batches * 1000, 1) if self.batches else 0.0,
+            "slowest_write_ms": round(self.slowest_write * 1000, 1),
+            "retried": self.retried,
+            "failed": self.failed,
+        }
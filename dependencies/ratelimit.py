@@ -0,0 +1,176 @@
+import logging
+import random
+import threading
+import time
+
+from google.api_core import exceptions
+
+logger = logging.getLogger(__name__)
+
+# quota errors: slow down as well as retry
+THROTTLE_ERRORS = (exceptions.TooManyRequests,)  # includes ResourceExhausted
+# transient errors worth retrying as they are
+RETRYABLE_ERRORS = THROTTLE_ERRORS + (
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.GatewayTimeout,
+    exceptions.DeadlineExceeded,
+    exceptions.Aborted,
+)
+
+# Refills the bucket for the time since the last call, then takes `cost` tokens. The balance may go negative: the
+# caller is told how long to wait for its token, and later callers queue behind it. Uses the server's clock so
+# workers on different machines agree. Returns the wait as a string, Lua numbers become integers otherwise.
+TAKE_TOKEN = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - cost
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 60)
+if tokens >= 0 then
+    return "0"
+end
+return tostring(-tokens / rate)
+"""
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=30.0):
+    # full-jitter exponential backoff
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RedisTokenBucket:
+    # token bucket shared by every worker using the same Redis key
+    def __init__(self, redis_client, key, rate, burst):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.script = redis_client.register_script(TAKE_TOKEN)
+
+    def take(self, cost=1):
+        # seconds to wait before the tokens just taken may be used
+        return float(self.script(keys=[self.key], args=[self.rate, self.burst, cost]))
+
+
+class LocalTokenBucket:
+    # the same bucket for a single process, when there's no Redis to share it through
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, cost=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate) - cost
+            self.ts = now
+            return max(0.0, -self.tokens / self.rate)
+
+
+class ApiLimiter:
+    # Limits calls to one Google API across workers and backs off when it pushes back:
+    # - a token bucket shared through Redis keeps the combined rate at `rate` per second, a call costing one token
+    #   unless call_cost() says otherwise (e.g. one per image of a batch request)
+    # - concurrency per worker is adjusted AIMD-style, +1 per window of successful calls up to max_concurrency,
+    #   halved (at most once a second) when the API returns a quota error
+    # - retryable errors are retried up to `retries` times with full-jitter exponential backoff
+    def __init__(self, name, redis_client=None, rate=10.0, burst=None, max_concurrency=16, retries=5,
+                 base_delay=0.5, max_delay=30.0):
+        self.name = name
+        burst = burst or max(rate, 1.0)
+        if redis_client is not None:
+            self.bucket = RedisTokenBucket(redis_client, f"ratelimit:{name}", rate, burst)
+        else:
+            self.bucket = LocalTokenBucket(rate, burst)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.limit = float(self.max_concurrency)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.active = 0
+        self.last_decrease = 0.0
+        self.calls = 0
+        self.delayed = 0
+        self.throttled = 0
+        self.retried = 0
+        self.failed = 0
+
+    def call(self, fn, *args, **kwargs):
+        return self.call_cost(1, fn, *args, **kwargs)
+
+    def call_cost(self, cost, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire(cost)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.record_error(e, attempt)
+                if delay is None:
+                    raise
+                logger.warning("%s call failed (%s), retry %s in %.1fs", self.name, e, attempt + 1, delay)
+            else:
+                self.record_success()
+                return result
+            finally:
+                self.release()
+            time.sleep(delay)
+            attempt += 1
+
+    def acquire(self, cost=1):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+        try:
+            wait = self.bucket.take(cost)
+        except Exception as e:
+            # a Redis outage shouldn't stop tagging; the API's own quota errors still slow us down
+            logger.warning("Rate limiter for %s unavailable, not waiting: %s", self.name, e)
+            wait = 0.0
+        if wait > 0:
+            self.delayed += 1
+            time.sleep(wait)
+        self.calls += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def record_success(self):
+        with self.condition:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify()
+
+    def record_error(self, error, attempt):
+        # returns how long to back off before retrying, or None if the error should be raised
+        if isinstance(error, THROTTLE_ERRORS):
+            self.throttled += 1
+            with self.condition:
+                now = time.monotonic()
+                if now - self.last_decrease >= 1.0:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+        if not isinstance(error, RETRYABLE_ERRORS) or attempt >= self.retries:
+            self.failed += 1
+            return None
+        self.retried += 1
+        return backoff_delay(attempt, self.base_delay, self.max_delay)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "concurrency": round(self.limit, 1),
+            "delayed": self.delayed,
+            "throttled": self.throttled,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# lookups remembered before their "used" times are written, when no put() writes them first
+TOUCH_BATCH = 256
+
+# The total size lives in the database and is kept up to date by triggers, in the same transaction as each change,
+# so every worker sharing the file sees what all of them have stored
+SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS responses (
+    media TEXT NOT NULL, features TEXT NOT NULL, version TEXT NOT NULL, size INTEGER NOT NULL,
+    used REAL NOT NULL, data BLOB NOT NULL, PRIMARY KEY (media, features, version)
+);
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL);
+INSERT OR IGNORE INTO totals (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM responses;
+CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN
+    UPDATE totals SET size = size + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN
+    UPDATE totals SET size = size - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN
+    UPDATE totals SET size = size + NEW.size - OLD.size WHERE id = 0;
+END;
+COMMIT;
+"""
+
+
+class ResponseCache:
+    # Raw API responses, zlib-compressed and keyed by (media hash, feature set, API version), so the same media is
+    # never paid for twice. The media hash is the md5 its MongoDB documents carry, so tags can be rebuilt offline
+    # document by document; content_key() stands in for callers that only have the bytes. A lookup is answered by
+    # any stored response whose features include the ones asked for. Once the responses stored by every worker
+    # sharing the file pass maxbytes, the least recently used are dropped until they're back under 90% of it.
+    # Cache errors are logged and treated as misses, so they never cost an API call its result.
+    def __init__(self, cachepath, maxbytes=2 * 1024 * 1024 * 1024):
+        self.cachepath = cachepath
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.touched = {}
+        self.lock = threading.Lock()
+        # autocommit, transactions are begun explicitly
+        self.db = sqlite3.connect(cachepath, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def content_key(media_binary):
+        return "sha256:" + hashlib.sha256(media_binary).hexdigest()
+
+    def get(self, media, features, version):
+        wanted = set(features)
+        with self.lock:
+            if self.db is None:
+                return None
+            try:
+                rows = self.db.execute(
+                    "SELECT features, data FROM responses WHERE media = ? AND version = ?", (media, version)
+                ).fetchall()
+                data = None
+                for stored, stored_data in rows:
+                    if wanted <= set(stored.split(",")):
+                        self.touched[(media, stored, version)] = time.time()
+                        data = stored_data
+                        break
+                if len(self.touched) >= TOUCH_BATCH:
+                    self._write_touched()
+            except sqlite3.Error as e:
+                logger.warning("Response cache lookup failed: %s", e)
+                data = None
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return zlib.decompress(data)
+
+    def put(self, media, features, version, data):
+        features = sorted(set(features))
+        stored_features = ",".join(features)
+        data = zlib.compress(data, 6)
+        with self.lock:
+            if self.db is None:
+                return
+            try:
+                self.db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._put(media, features, stored_features, version, data)
+                    self.db.execute("COMMIT")
+                except BaseException:
+                    self.db.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                logger.warning("Response cache store failed: %s", e)
+
+    def _put(self, media, features, stored_features, version, data):
+        self._write_touched()
+        # responses for some of these features are covered by this one from now on
+        for (stored,) in self.db.execute(
+            "SELECT features FROM responses WHERE media = ? AND version = ?", (media, version)
+        ).fetchall():
+            if stored != stored_features and set(stored.split(",")) <= set(features):
+                self.db.execute(
+                    "DELETE FROM responses WHERE media = ? AND features = ? AND version = ?", (media, stored, version)
+                )
+        self.db.execute(
+            "INSERT INTO responses (media, features, version, size, used, data) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (media, features, version) DO UPDATE SET size = excluded.size, used = excluded.used, "
+            "data = excluded.data",
+            (media, stored_features, version, len(data), time.time(), data),
+        )
+        # read inside the write transaction, so it includes what other workers stored
+        size = self.db.execute("SELECT size FROM totals WHERE id = 0").fetchone()[0]
+        if size > self.maxbytes:
+            self._evict(size, self.maxbytes * 9 // 10)
+
+    def _evict(self, size, target):
+        dropped = []
+        for media, features, version, rowsize in self.db.execute(
+            "SELECT media, features, version, size FROM responses ORDER BY used"
+        ):
+            if size <= target:
+                break
+            dropped.append((media, features, version))
+            size -= rowsize
+        self.db.executemany("DELETE FROM responses WHERE media = ? AND features = ? AND version = ?", dropped)
+        self.evicted += len(dropped)
+        logger.info("Evicted %s cached API responses from %s", len(dropped), self.cachepath)
+
+    def _write_touched(self):
+        # records when looked-up responses were last used, for eviction; joins a transaction already open
+        if not self.touched:
+            return
+        self.db.executemany(
+            "UPDATE responses SET used = ? WHERE media = ? AND features = ? AND version = ?",
+            [(used,) + key for key, used in self.touched.items()],
+        )
+        self.touched.clear()
+
+    def stats(self):
+        with self.lock:
+            size = None
+            if self.db is not None:
+                try:
+                    size = self.db.execute("SELECT size FROM totals WHERE id = 0").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+            return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted, "bytes": size}
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                try:
+                    self._write_touched()
+                except sqlite3.Error as e:
+                    logger.warning("Couldn't record response cache use: %s", e)
+                self.db.close()
+                self.db = None
@@ -0,0 +1,71 @@
+import json
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ScanJournal:
+    # Per-directory mtimes from the last complete scan, so unchanged folders can be skipped without listing them.
+    # A folder's mtime changes when entries are added, removed or renamed, but not when a file is edited in place;
+    # run a full scan to pick those up.
+    def __init__(self, journalpath, settings, full=False):
+        self.journalpath = journalpath
+        self.full = full
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.lock = threading.Lock()
+        self.updates = {}
+        self.skipped = 0
+        self.skipped_entries = 0
+        self.scanned = 0
+        self.db = sqlite3.connect(journalpath, timeout=60, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS folders ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, entries INTEGER NOT NULL, subdirs TEXT NOT NULL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.commit()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+        if not full and row is not None and row[0] != self.settings:
+            logger.warning("Scan settings changed since the last scan, rescanning every folder")
+            self.full = True
+
+    def unchanged(self, path, stat):
+        # returns the folder's subdirectory names if it can be skipped, otherwise None
+        with self.lock:
+            row = None
+            if not self.full:
+                row = self.db.execute(
+                    "SELECT mtime_ns, entries, subdirs FROM folders WHERE path = ?", (path,)
+                ).fetchone()
+            if row is None or row[0] != stat.st_mtime_ns:
+                self.scanned += 1
+                return None
+            self.skipped += 1
+            self.skipped_entries += row[1]
+            self.updates[path] = row
+            return json.loads(row[2])
+
+    def record(self, path, stat, entries, subdirs):
+        with self.lock:
+            self.updates[path] = (stat.st_mtime_ns, entries, json.dumps(subdirs))
+
+    def commit(self):
+        # only called after a complete scan; folders not seen this time are dropped
+        with self.lock:
+            self.db.execute("DELETE FROM folders")
+            self.db.executemany(
+                "INSERT INTO folders (path, mtime_ns, entries, subdirs) VALUES (?, ?, ?, ?)",
+                [(path,) + row for path, row in self.updates.items()],
+            )
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('settings', ?)", (self.settings,))
+            self.db.commit()
+        logger.info("Saved scan journal %s with %s folders", self.journalpath, len(self.updates))
+
+    def stats(self):
+        return {"skipped": self.skipped, "rescanned": self.scanned, "skipped_entries": self.skipped_entries}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,30 +1,181 @@
+import asyncio
 import logging
 import os
+import threading
+import time
+from collections import deque
 
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import vision
 
+from dependencies.ratelimit import THROTTLE_ERRORS
+
 logger = logging.getLogger(__name__)
 
+# annotate() feature names and the Vision features they request
+VISION_FEATURES = {
+    "tags": vision.Feature.Type.LABEL_DETECTION,
+    "text": vision.Feature.Type.TEXT_DETECTION,
+    "explicit": vision.Feature.Type.SAFE_SEARCH_DETECTION,
+}
+# batch_annotate_images takes at most 16 images, and at most 10 MB of JSON (content is base64, so ~7.5 MB raw)
+VISION_BATCH_IMAGES = 16
+VISION_BATCH_BYTES = 7 * 1024 * 1024
+# part of every ResponseCache key, so responses from another API version are never mixed in
+VISION_API_VERSION = "vision/v1"
+
 
 class Tagging:
-    def __init__(self, google_credentials, google_project, tags_backend):
+    def __init__(self, google_credentials, google_project, tags_backend, endpoint=None, limiter=None, cache=None):
+        # endpoint points the client at another Vision server over HTTP without credentials,
+        # e.g. "http://localhost:8095" for fake_vision_server.py; limiter is a ratelimit.ApiLimiter,
+        # cache a responsecache.ResponseCache
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = google_credentials
         os.environ["GOOGLE_CLOUD_PROJECT"] = google_project
         if tags_backend: self.tags_backend = tags_backend
         else: self.tags_backend = 'google-vision'
+        self.endpoint = endpoint
+        self.limiter = limiter
+        self.cache = cache
+        self._client = None
+        self.batches = 0
+        self.batched_images = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def client(self):
+        # one client for the life of the Tagging object, so its channel and auth are reused between calls
+        if self._client is None:
+            if self.endpoint:
+                self._client = vision.ImageAnnotatorClient(
+                    credentials=AnonymousCredentials(), transport="rest",
+                    client_options={"api_endpoint": self.endpoint},
+                )
+            else:
+                self._client = vision.ImageAnnotatorClient()
+        return self._client
+
+    def annotate(self, image_binary, features=("tags", "text", "explicit"), media=None):
+        # every requested feature in one request, returned as {"tags": [...], "text": [...], "explicit": safe};
+        # media is the md5 the image's documents carry, which cached responses are kept under
+        if self.tags_backend == 'google-vision':
+            return self.google_vision_annotate(image_binary=image_binary, features=features, media=media)
+        elif self.tags_backend == 'aws-rekognition':
+            return {feature: self.aws_rekognition(image_binary=image_binary) for feature in features}
+        else:
+            raise Exception("tags_backend must be a valid backend.")
+
+    def limited(self, fn, *args, cost=1, **kwargs):
+        if self.limiter is None:
+            return fn(*args, **kwargs)
+        return self.limiter.call_cost(cost, fn, *args, **kwargs)
+
+    def google_vision_annotate(self, image_binary, features, media=None):
+        return parse_annotations(self.annotate_response(image_binary, features, media), features)
+
+    def annotate_response(self, image_binary, features, media=None):
+        # the raw AnnotateImageResponse, from the cache when these features were already requested for this image
+        response = self.cached_response(image_binary, features, media)
+        if response is None:
+            response = self.limited(self.google_vision_response, image_binary, features)
+            self.cache_response(image_binary, features, response, media)
+        return response
+
+    def google_vision_response(self, image_binary, features):
+        response = self.client.annotate_image(annotate_request(image_binary, features))
+        check_response(response)
+        return response
+
+    def cache_media(self, image_binary, media):
+        # the image's md5 when the caller knows it, so a re-encoded upload still finds the response for its original
+        return media if media is not None else self.cache.content_key(image_binary)
 
-    def get_tags(self, image_binary):
+    def cached_response(self, image_binary, features, media=None):
+        if self.cache is None:
+            return None
+        data = self.cache.get(self.cache_media(image_binary, media), features, VISION_API_VERSION)
+        return None if data is None else vision.AnnotateImageResponse.deserialize(data)
+
+    def cache_response(self, image_binary, features, response, media=None):
+        if self.cache is not None:
+            self.cache.put(self.cache_media(image_binary, media), features, VISION_API_VERSION,
+                           vision.AnnotateImageResponse.serialize(response))
+
+    def annotate_batch(self, items, batchsize=VISION_BATCH_IMAGES):
+        # items are (image_binary, features, media) triples, media as for annotate(). Returns one result per item, in
+        # order: what annotate() returns, or the exception raised if the item still failed when retried on its own.
+        # A batch that's over quota isn't split: after the limiter's retries its images all fail with that error
+        if self.tags_backend != 'google-vision':
+            return [self.try_annotate(*item) for item in items]
+        results = [None] * len(items)
+        pending = []
+        for i, (image_binary, features, media) in enumerate(items):
+            response = self.cached_response(image_binary, features, media)
+            if response is None:
+                pending.append(i)
+            else:
+                results[i] = parse_annotations(response, features)
+        for chunk in batch_chunks(pending, items, min(batchsize, VISION_BATCH_IMAGES)):
+            try:
+                response = self.limited(
+                    self.client.batch_annotate_images, requests=[annotate_request(*items[i][:2]) for i in chunk],
+                    cost=len(chunk),
+                )
+                responses = list(response.responses)
+            except THROTTLE_ERRORS as e:
+                # one request per image would only multiply the traffic that's over quota
+                logger.warning("Vision batch of %s images is over quota, failing them: %s", len(chunk), e)
+                self.batches += 1
+                self.batched_images += len(chunk)
+                self.failed += len(chunk)
+                for i in chunk:
+                    results[i] = e
+                continue
+            except Exception as e:
+                logger.warning("Vision batch of %s images failed, retrying them one at a time: %s", len(chunk), e)
+                responses = []
+            # anything without a response of its own is retried alone below
+            responses += [None] * (len(chunk) - len(responses))
+            self.batches += 1
+            self.batched_images += len(chunk)
+            for i, response in zip(chunk, responses):
+                if response is not None and not response.error.message:
+                    image_binary, features, media = items[i]
+                    self.cache_response(image_binary, features, response, media)
+                    results[i] = parse_annotations(response, items[i][1])
+                    continue
+                if response is not None:
+                    logger.warning("Vision failed on one image in a batch, retrying it alone: %s",
+                                   response.error.message)
+                self.retried += 1
+                results[i] = self.try_annotate(*items[i])
+        return results
+
+    def try_annotate(self, image_binary, features, media=None):
+        try:
+            return self.annotate(image_binary, features, media)
+        except Exception as e:
+            self.failed += 1
+            return e
+
+    def stats(self):
+        return {"batches": self.batches, "batched_images": self.batched_images, "retried": self.retried,
+                "failed": self.failed}
+
+    def get_tags(self, image_binary, media=None):
         if self.tags_backend == 'google-vision':
-            tags = self.google_vision_labels(image_binary=image_binary)
+            tags = self.google_vision_labels(image_binary=image_binary, media=media)
         elif self.tags_backend == 'aws-rekognition':
             tags = self.aws_rekognition(image_binary=image_binary)
         else:
             raise Exception("tags_backend must be a valid backend.")
         return tags
 
-    def get_text(self, image_binary):
+    def get_text(self, image_binary, media=None):
         if self.tags_backend == 'google-vision':
-            text = self.google_vision_light_ocr(image_binary=image_binary)
+            text = self.google_vision_light_ocr(image_binary=image_binary, media=media)
         elif self.tags_backend == 'aws-rekognition':
             text = self.aws_rekognition(image_binary=image_binary)
         else:
@@ -41,59 +192,33 @@ class Tagging:
             raise Exception("tags_backend must be a valid backend.")
         return ocrtext
 
-    def google_vision_labels(self, image_binary):
-        client = vision.ImageAnnotatorClient()
-        # Loads the image into memory
-        image = vision.Image(content=image_binary)
-        # Performs label detection on the image file
-        responsetags = client.label_detection(image=image)
-        labels = responsetags.label_annotations
-        tags = []
-        for label in labels:
-            tags.append(label.description)
-        return tags
+    def google_vision_labels(self, image_binary, media=None):
+        return label_descriptions(self.annotate_response(image_binary, ("tags",), media))
 
-    def get_explicit(self, image_binary):
+    def get_explicit(self, image_binary, media=None):
         if self.tags_backend == 'google-vision':
-            text = self.google_vision_explicit_detection(image_binary=image_binary)
+            text = self.google_vision_explicit_detection(image_binary=image_binary, media=media)
         elif self.tags_backend == 'aws-rekognition':
             text = self.aws_rekognition(image_binary=image_binary)
         else:
             raise Exception("tags_backend must be a valid backend.")
         return text
 
-    def google_vision_light_ocr(self, image_binary):
-        client = vision.ImageAnnotatorClient()
-        # Loads the image into memory
-        image = vision.Image(content=image_binary)
-        # Performs label detection on the image file
-        responsetags = client.text_detection(image=image)
-        textobject = responsetags.text_annotations
-        returntext = []
-        for text in textobject:
-            returntext.append(text.description)
-        if not returntext:
-            logger.info("Text not found in image, appending placeholder")
-            returntext.append("No text detected.")
-        return returntext
+    def google_vision_light_ocr(self, image_binary, media=None):
+        return text_descriptions(self.annotate_response(image_binary, ("text",), media))
 
     # TODO: this doesn't work yet
     def google_vision_heavy_ocr(self, image_binary):
-        client = vision.ImageAnnotatorClient()
         # Loads the image into memory
         image = vision.Image(content=image_binary)
         # Performs label detection on the image file
-        response = client.document_text_detection(image=image)
+        response = self.limited(self.client.document_text_detection, image=image)
         textobject = response.text_annotations
         returntext = textobject
         return returntext
 
-    def google_vision_explicit_detection(self, image_binary):
-        client = vision.ImageAnnotatorClient()
-        # Loads the image into memory
-        image = vision.Image(content=image_binary)
-        # Performs label detection on the image file
-        response = client.safe_search_detection(image=image)
+    def google_vision_explicit_detection(self, image_binary, media=None):
+        response = self.annotate_response(image_binary, ("explicit",), media)
         safe = response.safe_search_annotation
         # Names of likelihood from google.cloud.vision.enums
         likelihood_name = (
@@ -111,3 +236,163 @@ class Tagging:
     def aws_rekognition(self, image_binary):
         return True
         # TODO add AWS support
+
+
+def label_descriptions(response):
+    return [label.description for label in response.label_annotations]
+
+
+def text_descriptions(response):
+    returntext = [text.description for text in response.text_annotations]
+    if not returntext:
+        logger.info("Text not found in image, appending placeholder")
+        returntext.append("No text detected.")
+    return returntext
+
+
+class AsyncTagging:
+    # Runs Vision requests on an asyncio loop in a background thread, with up to `inflight` of them waiting on the
+    # network at once. submit() returns a concurrent.futures.Future, so synchronous code can start requests, do
+    # other work (deepb) and collect the results later. Uses the async gRPC client; with a Tagging endpoint set,
+    # which only has a REST transport, the synchronous client runs on executor threads instead.
+    def __init__(self, tagging, inflight=8):
+        self.tagging = tagging
+        self.inflight = max(inflight, 1)
+        self._client = None
+        self.semaphore = None
+        self.running = 0
+        self.peak = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="vision-async", daemon=True)
+        self.thread.start()
+
+    def submit(self, image_binary, features=("tags", "text", "explicit"), media=None):
+        return asyncio.run_coroutine_threadsafe(self.annotate(image_binary, features, media), self.loop)
+
+    async def annotate(self, image_binary, features, media=None):
+        # the cache is SQLite, so it's read and written on executor threads rather than stalling the loop
+        if self.tagging.tags_backend != 'google-vision':
+            return await self.loop.run_in_executor(None, self.tagging.annotate, image_binary, features, media)
+        response = await self.loop.run_in_executor(None, self.tagging.cached_response, image_binary, features, media)
+        if response is not None:
+            return parse_annotations(response, features)
+        if self.semaphore is None:
+            # created here so they belong to the loop's thread
+            self.semaphore = asyncio.Semaphore(self.inflight)
+        async with self.semaphore:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            start = time.monotonic()
+            try:
+                if self.tagging.endpoint:
+                    response = await self.loop.run_in_executor(
+                        None, self.tagging.limited, self.tagging.google_vision_response, image_binary, features
+                    )
+                else:
+                    response = await self.google_vision_annotate(image_binary, features)
+                await self.loop.run_in_executor(
+                    None, self.tagging.cache_response, image_binary, features, response, media
+                )
+                result = parse_annotations(response, features)
+                self.completed += 1
+                return result
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.running -= 1
+                self.latencies.append(time.monotonic() - start)
+
+    async def google_vision_annotate(self, image_binary, features):
+        # the same retries and limits as ApiLimiter.call, waiting with asyncio instead of blocking the loop
+        limiter = self.tagging.limiter
+        if limiter is None:
+            return await self.google_vision_annotate_once(image_binary, features)
+        attempt = 0
+        while True:
+            await self.loop.run_in_executor(None, limiter.acquire)
+            try:
+                result = await self.google_vision_annotate_once(image_binary, features)
+            except Exception as e:
+                delay = limiter.record_error(e, attempt)
+                if delay is None:
+                    raise
+                logger.warning("Vision call failed (%s), retry %s in %.1fs", e, attempt + 1, delay)
+            else:
+                limiter.record_success()
+                return result
+            finally:
+                limiter.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def google_vision_annotate_once(self, image_binary, features):
+        if self._client is None:
+            self._client = vision.ImageAnnotatorAsyncClient()
+        response = await self._client.batch_annotate_images(requests=[annotate_request(image_binary, features)])
+        response = response.responses[0]
+        check_response(response)
+        return response
+
+    def stats(self):
+        # latency percentiles over the last 1000 requests
+        latencies = sorted(self.latencies.copy())
+        return {
+            "in_flight": self.running,
+            "peak_in_flight": self.peak,
+            "completed": self.completed,
+            "failed": self.failed,
+            **{f"p{q}_ms": round(percentile(latencies, q) * 1000, 1) for q in (50, 90, 99)},
+        }
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(values, q):
+    # nearest-rank percentile of an already sorted list
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, -(-len(values) * q // 100) - 1))]
+
+
+def annotate_request(image_binary, features):
+    return vision.AnnotateImageRequest(
+        image=vision.Image(content=image_binary),
+        features=[vision.Feature(type_=VISION_FEATURES[feature]) for feature in features],
+    )
+
+
+def batch_chunks(indexes, items, batchsize):
+    # the given item indexes in lists that each stay within the per-request image count and size limits
+    chunk, chunkbytes = [], 0
+    for i in indexes:
+        image_binary = items[i][0]
+        if chunk and (len(chunk) >= batchsize or chunkbytes + len(image_binary) > VISION_BATCH_BYTES):
+            yield chunk
+            chunk, chunkbytes = [], 0
+        chunk.append(i)
+        chunkbytes += len(image_binary)
+    if chunk:
+        yield chunk
+
+
+def check_response(response):
+    # per-image errors come back inside the response; raised as the matching api_core exception, so quota errors
+    # are retried by the limiter like the same status on the whole call would be
+    if response.error.message:
+        raise exceptions.from_grpc_status(response.error.code, f"Vision annotation failed: {response.error.message}")
+
+
+def parse_annotations(response, features):
+    # one AnnotateImageResponse to the same values get_tags, get_text and get_explicit return
+    parsers = {
+        "tags": label_descriptions,
+        "text": text_descriptions,
+        "explicit": lambda response: response.safe_search_annotation,
+    }
+    return {feature: parsers[feature](response) for feature in features}
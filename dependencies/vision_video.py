@@ -1,18 +1,66 @@
 import logging
 import os
+import time
 from configparser import ConfigParser
 
 from google.cloud import videointelligence
 
+from dependencies.ratelimit import RETRYABLE_ERRORS, backoff_delay
+
 # read config
 config = ConfigParser()
 config.read("config.ini")
 
 logger = logging.getLogger(__name__)
 
+# seconds to wait for an annotation to finish
+VIDEO_TIMEOUT = 600
+# retries of a failed poll of an operation that's already running
+POLL_RETRIES = 5
+
+# part of every ResponseCache key, so responses from another API version are never mixed in
+VIDEO_API_VERSION = "videointelligence/v1"
+
+
+def cache_features(request):
+    # feature names, plus the transcription settings when there's a transcript, since they change it too
+    features = [videointelligence.Feature(feature).name for feature in request["features"]]
+    if "SPEECH_TRANSCRIPTION" in features:
+        speech = request["video_context"].speech_transcription_config
+        features.append(f"language={speech.language_code}")
+        features.append(f"punctuation={speech.enable_automatic_punctuation}")
+    return features
+
+
+def wait_for(operation, timeout=VIDEO_TIMEOUT):
+    # Polls an operation that's already running. A transient error while polling is retried on the same operation,
+    # since starting a new one would pay for the annotation again; an operation that failed raises its own error.
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            return operation.result(timeout=max(1.0, deadline - time.monotonic()))
+        except RETRYABLE_ERRORS as e:
+            if attempt >= POLL_RETRIES or time.monotonic() >= deadline or operation_failed(operation):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning("Polling video annotation failed (%s), retry %s in %.1fs", e, attempt + 1, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def operation_failed(operation):
+    # done() doesn't poll again once the operation has finished
+    try:
+        return operation.done()
+    except RETRYABLE_ERRORS:
+        return False
+
 
 class VideoData:
-    def __init__(self, google_credentials, google_project):
+    def __init__(self, google_credentials, google_project, limiter=None, cache=None):
+        # limiter is a ratelimit.ApiLimiter for submitting annotations; waiting on one that's running isn't limited
+        # cache is a responsecache.ResponseCache, checked before the same video is uploaded for features it already has
         self.text = []
         self.labels = []
         self.labels_category = []
@@ -21,8 +69,28 @@ class VideoData:
         self.pornography = []
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = google_credentials
         os.environ["GOOGLE_CLOUD_PROJECT"] = google_project
+        self.limiter = limiter
+        self.cache = cache
 
-    def video_vision_all(self, video_binary):
+    def annotate(self, video_client, request, media=None):
+        # media is the md5 the video's document carries, which the cached response is kept under
+        def submit():
+            return video_client.annotate_video(request=request)
+        if self.cache is not None:
+            if media is None:
+                media = self.cache.content_key(request["input_content"])
+            features = cache_features(request)
+            data = self.cache.get(media, features, VIDEO_API_VERSION)
+            if data is not None:
+                return videointelligence.AnnotateVideoResponse.deserialize(data)
+        operation = submit() if self.limiter is None else self.limiter.call(submit)
+        result = wait_for(operation)
+        if self.cache is not None:
+            self.cache.put(media, features, VIDEO_API_VERSION,
+                           videointelligence.AnnotateVideoResponse.serialize(result))
+        return result
+
+    def video_vision_all(self, video_binary, media=None):
         video_client = videointelligence.VideoIntelligenceServiceClient()
         features = [
             videointelligence.Feature.LABEL_DETECTION,
@@ -36,15 +104,16 @@ class VideoData:
         video_context = videointelligence.VideoContext(
             speech_transcription_config=vision_config
         )
-        operation = video_client.annotate_video(
-            request={
+        print("\nProcessing video for all annotations:")
+        result = self.annotate(
+            video_client,
+            {
                 "features": features,
                 "input_content": video_binary,
                 "video_context": video_context,
-            }
+            },
+            media,
         )
-        print("\nProcessing video for all annotations:")
-        result = operation.result(timeout=600)
         print("\nFinished processing.")
 
         for annotation_result in result.annotation_results:
@@ -66,7 +135,7 @@ class VideoData:
         # remove duplicates
         self.pornography = list(dict.fromkeys(self.pornography))
 
-    def video_vision_explicit(self, video_binary):
+    def video_vision_explicit(self, video_binary, media=None):
         video_client = videointelligence.VideoIntelligenceServiceClient()
         features = [videointelligence.Feature.EXPLICIT_CONTENT_DETECTION]
         vision_config = videointelligence.SpeechTranscriptionConfig(
@@ -75,15 +144,16 @@ class VideoData:
         video_context = videointelligence.VideoContext(
             speech_transcription_config=vision_config
         )
-        operation = video_client.annotate_video(
-            request={
+        logger.info("Processing video for all annotations:")
+        result = self.annotate(
+            video_client,
+            {
                 "features": features,
                 "input_content": video_binary,
                 "video_context": video_context,
-            }
+            },
+            media,
         )
-        logger.info("Processing video for all annotations:")
-        result = operation.result(timeout=600)
         logger.info("Finished processing.")
         for frame in result.annotation_results[0].explicit_annotation.frames:
             likelihood = videointelligence.Likelihood(frame.pornography_likelihood)
@@ -0,0 +1,124 @@
+import io
+import logging
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# formats Vision takes that are already compressed well enough to send as they are when small enough
+COMPACT_FORMATS = {"JPEG", "WEBP"}
+# largest side WebP can encode
+WEBP_MAX_SIDE = 16383
+EXIF_ORIENTATION = 0x0112
+
+
+class UploadPreprocessor:
+    # Shrinks images before they're sent to Vision: anything with a side over `maxside` is downscaled, and anything
+    # not already a JPEG or WebP under `maxbytes` is re-encoded as `format` at `quality`. Vision's labels and OCR don't
+    # need more than a couple of thousand pixels a side, and large PNGs mostly cost upload time.
+    # With screenshot_fullres, screenshots keep their resolution for OCR and are only re-encoded losslessly (WebP).
+    # The original bytes are sent whenever the result wouldn't be smaller, or the image can't be decoded or shrunk.
+    def __init__(self, maxside=2048, format="JPEG", quality=88, screenshot_fullres=True, maxbytes=4 * 1024 * 1024):
+        self.maxside = maxside
+        self.format = format.upper()
+        self.quality = quality
+        self.screenshot_fullres = screenshot_fullres
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.images = 0
+        self.resized = 0
+        self.reencoded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.encode_time = 0.0
+
+    def prepare(self, content, is_screenshot=False, image=None):
+        # bytes to upload for `content`; image is its decoded raster if the caller already has one, and isn't changed
+        return self.shrink(content, is_screenshot, image)[0]
+
+    def shrink(self, content, is_screenshot=False, image=None):
+        # prepare(), plus whether the image had to be decoded here
+        start = time.perf_counter()
+        resized = False
+        decoded = image is None
+        try:
+            upload, resized, decoded = self.encode(content, is_screenshot == 1 and self.screenshot_fullres, image)
+        except Exception as e:
+            # anything Pillow raises, including DecompressionBombError for images past its pixel limit; Vision
+            # reports its own error for an image that really is broken
+            logger.warning("Couldn't shrink image for upload, sending it as it is: %s", e)
+            upload = content
+        if len(upload) >= len(content):
+            upload, resized = content, False
+        with self.lock:
+            self.images += 1
+            self.resized += resized
+            self.reencoded += upload is not content
+            self.bytes_in += len(content)
+            self.bytes_out += len(upload)
+            self.encode_time += time.perf_counter() - start
+        return upload, decoded
+
+    def encode(self, content, fullres, image=None):
+        # returns the bytes, whether they were resized and whether the image was decoded here
+        decoded = image is None
+        if decoded:
+            # only the header is read until the pixels are needed
+            image = Image.open(io.BytesIO(content))
+        oversized = max(image.size) > self.maxside and not fullres
+        if not oversized and image.format in COMPACT_FORMATS and len(content) <= self.maxbytes:
+            return content, False, False
+        if fullres and max(image.size) > WEBP_MAX_SIDE:
+            return content, False, False
+        if oversized:
+            # JPEGs decode straight to a reduced scale; draft keeps at least the requested size
+            image.draft("RGB", (self.maxside, self.maxside))
+            if image.mode not in ("RGB", "RGBA", "L", "LA"):
+                # palette and 1-bit images only resize with nearest neighbour
+                image = image.convert("RGBA" if has_alpha(image) else "RGB")
+            scale = self.maxside / max(image.size)
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            # the EXIF doesn't survive the re-encode, so rotate the pixels instead
+            image = ImageOps.exif_transpose(image)
+        output = io.BytesIO()
+        if fullres:
+            image = image.convert("RGBA" if has_alpha(image) else "RGB")
+            image.save(output, "WEBP", lossless=True, quality=50, method=1)
+        elif self.format == "WEBP":
+            image = image.convert("RGBA" if has_alpha(image) else "RGB")
+            image.save(output, "WEBP", quality=self.quality, method=4)
+        else:
+            flatten(image).save(output, "JPEG", quality=self.quality, optimize=True)
+        return output.getvalue(), oversized, decoded
+
+    def stats(self):
+        with self.lock:
+            saved = self.bytes_in - self.bytes_out
+            return {
+                "images": self.images,
+                "resized": self.resized,
+                "reencoded": self.reencoded,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "saved_bytes": saved,
+                "saved_pct": round(saved / self.bytes_in * 100, 1) if self.bytes_in else 0.0,
+                "mean_encode_ms": round(self.encode_time / self.images * 1000, 1) if self.images else 0.0,
+            }
+
+
+def has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def flatten(image):
+    # JPEG has no alpha: transparent areas go white rather than whatever colour the hidden pixels happen to be
+    if not has_alpha(image):
+        return image.convert("RGB")
+    image = image.convert("RGBA")
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
@@ -0,0 +1,101 @@
+import argparse
+import base64
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-in for the Vision images:annotate REST endpoint, for exercising Tagging without credentials or cost.
+# Answers every feature with values derived from the image's md5, and can inject failures.
+# Point the server at it with vision-endpoint = http://localhost:8095 under [image-recognition].
+
+# the REST client sends enums as numbers
+FEATURE_NAMES = {4: "LABEL_DETECTION", 5: "TEXT_DETECTION", 6: "SAFE_SEARCH_DETECTION"}
+
+counts = {"requests": 0, "images": 0, "failed_images": 0, "rejected_requests": 0}
+counts_lock = threading.Lock()
+
+
+def annotate(request, fail):
+    if fail:
+        return {"error": {"code": 13, "message": "injected failure"}}
+    md5 = hashlib.md5(base64.b64decode(request["image"].get("content", ""))).hexdigest()
+    response = {}
+    for feature in request.get("features", []):
+        name = FEATURE_NAMES.get(feature.get("type"), feature.get("type"))
+        if name == "LABEL_DETECTION":
+            response["labelAnnotations"] = [{"description": f"label-{md5[:8]}", "score": 0.9}]
+        elif name == "TEXT_DETECTION":
+            response["textAnnotations"] = [{"description": f"text {md5[:8]}"}, {"description": "text"}]
+        elif name == "SAFE_SEARCH_DETECTION":
+            response["safeSearchAnnotation"] = {field: "VERY_UNLIKELY" for field in
+                                                ("adult", "spoof", "medical", "violence", "racy")}
+    return response
+
+
+class Handler(BaseHTTPRequestHandler):
+    fail_every = 0
+    reject_batches = False
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/v1/images:annotate":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        requests = body.get("requests", [])
+        with counts_lock:
+            counts["requests"] += 1
+            if self.reject_batches and len(requests) > 1:
+                counts["rejected_requests"] += 1
+                reject = True
+            else:
+                reject = False
+                fails = []
+                for _ in requests:
+                    counts["images"] += 1
+                    fails.append(bool(self.fail_every) and counts["images"] % self.fail_every == 0)
+                counts["failed_images"] += sum(fails)
+        if reject:
+            # a non-retryable status, so the client gives up on the batch straight away
+            self.send_json(400, {"error": {"code": 400, "message": "injected batch rejection",
+                                           "status": "INVALID_ARGUMENT"}})
+            return
+        self.send_json(200, {"responses": [annotate(request, fail) for request, fail in zip(requests, fails)]})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8095, fail_every=0, reject_batches=False):
+    Handler.fail_every = fail_every
+    Handler.reject_batches = reject_batches
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Vision images:annotate endpoint")
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--fail-every", type=int, default=0, help="fail every Nth image with a per-image error")
+    parser.add_argument("--reject-batches", action="store_true", help="answer multi-image requests with a 400")
+    args = parser.parse_args()
+    server = serve(args.port, args.fail_every, args.reject_batches)
+    print(f"Fake Vision endpoint on http://127.0.0.1:{args.port}, Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(counts)
+
+
+if __name__ == "__main__":
+    main()
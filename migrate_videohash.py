@@ -0,0 +1,81 @@
+import argparse
+import concurrent.futures
+import logging
+import os
+import subprocess
+import sys
+
+import pymongo
+
+from dependencies.configops import MainConfig
+from dependencies.fileops import configure_ffmpeg_pool, get_video_content_md5, get_video_packet_md5
+
+# Records both video identifiers (content_md5 and packet_md5) on existing videocollection docs,
+# so client dedupe keeps working while videohash is switched from "content" to "packet".
+
+# initialize logger
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# read config
+config = MainConfig("config.ini")
+
+# initialize DBs
+currentdb = pymongo.MongoClient(config.connectstring)[config.mongodbname]
+videocollection = currentdb[config.mongovideocollection]
+
+hashfunctions = {"packet_md5": get_video_packet_md5, "content_md5": get_video_content_md5}
+
+
+def find_local_path(document):
+    for path in document.get("path") or []:
+        if os.path.isfile(path):
+            return path
+    subdiv = document.get("subdiv")
+    if subdiv and config.config.has_option("divs", subdiv):
+        for relpath in document.get("relativepath") or []:
+            path = os.path.join(config.getdiv(subdiv), relpath)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def migrate_document(document, field):
+    path = find_local_path(document)
+    if path is None:
+        logger.warning("No local file found for video document %s, skipping", document["_id"])
+        return "missing"
+    try:
+        md5 = hashfunctions[field](path)
+    except subprocess.TimeoutExpired:
+        logger.warning("Timed out hashing %s for document %s, it's left for the next run", path, document["_id"])
+        return "timeout"
+    if md5 == "corrupt":
+        logger.warning("Could not hash %s for document %s", path, document["_id"])
+        return "corrupt"
+    videocollection.update_one({"_id": document["_id"]}, {"$set": {field: md5}})
+    logger.info("Set %s=%s on document %s from %s", field, md5, document["_id"], path)
+    return "updated"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record both video identifiers on existing video documents")
+    parser.add_argument("--content", action="store_true",
+                        help="backfill content_md5 on documents created in packet mode (full decode, slow)")
+    args = parser.parse_args()
+    ffmpeg_pool = configure_ffmpeg_pool(config.ffmpeg_workers, config.ffmpeg_timeout, config.ffmpeg_content_timeout)
+    videocollection.create_index("packet_md5")
+    fields = ["packet_md5", "content_md5"] if args.content else ["packet_md5"]
+    counts = {"updated": 0, "missing": 0, "corrupt": 0, "timeout": 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.hashers) as pool:
+        for field in fields:
+            documents = videocollection.find({field: {"$exists": False}}, {"path": 1, "relativepath": 1, "subdiv": 1})
+            for result in pool.map(lambda document: migrate_document(document, field), documents):
+                counts[result] += 1
+    ffmpeg_pool.shutdown()
+    logger.warning("Video hash migration finished: %s", counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import logging
 import os
+import subprocess
 import sys
 from configparser import ConfigParser
 
 import pymongo
 
-from dependencies.fileops import get_image_md5, get_video_content_md5, listdirs
+from dependencies.fileops import (close_hash_cache, get_image_md5, get_video_content_md5, get_video_packet_md5, listdirs,
+                                  open_hash_cache)
 from dependencies.vision import Tagging
 
 # initialize logger
@@ -26,6 +28,8 @@ mongoscreenshotcollection = config.get("storage", "mongoscreenshotcollection")
 mongovideocollection = config.get("storage", "mongovideocollection")
 process_images = config.getboolean("storage", "process_images")
 process_videos = config.getboolean("storage", "process_videos")
+open_hash_cache(config.get("storage", "hashcache", fallback="hashcache.db"))
+videohash = config.get("properties", "videohash", fallback="content")
 
 currentdb = pymongo.MongoClient(connectstring)[mongodbname]
 collection = currentdb[mongocollection]
@@ -33,6 +37,10 @@ screenshotcollection = currentdb[mongoscreenshotcollection]
 videocollection = currentdb[mongovideocollection]
 
 videoextensions = (".mp4", ".webm", ".mov", ".mkv")
+# video identity fields and the hash each is computed with, as in migrate_videohash.py; the configured mode's field
+# is checked first, documents written before a switch may only have the other
+hashfunctions = {"packet_md5": get_video_packet_md5, "content_md5": get_video_content_md5}
+videohashfields = ["packet_md5", "content_md5"] if videohash == "packet" else ["content_md5", "packet_md5"]
 imageextensions = (".png", ".jpg", ".gif", ".jpeg")
 
 if subdiv.find("screenshots") != -1:
@@ -96,9 +104,13 @@ def main():
         if process_videos:
             logger.info("Processing video DB %s", mongovideocollection)
             for document in list(videocollection.find({"subdiv": subdiv})):
+                hashfield = next((field for field in videohashfields if document.get(field)), None)
+                if hashfield is None:
+                    logger.warning("No video hash on document %s, skipping", document["_id"])
+                    continue
                 for relpath in document["relativepath"]:
                     logger.info("Processing relative path")
-                    docmd5 = document["content_md5"]
+                    docmd5 = document[hashfield]
                     logger.info("Doc MD5 is %s", docmd5)
                     if relpath.endswith(videoextensions):
                         removepath = False
@@ -108,9 +120,11 @@ def main():
                         filefound = os.path.isfile(fullpath)
                         logger.info("File found status: %s", filefound)
                         if filefound:
-                            vid_md5 = get_video_content_md5(
-                                os.path.join(rootdir, relpath)
-                            )
+                            try:
+                                vid_md5 = hashfunctions[hashfield](os.path.join(rootdir, relpath))
+                            except subprocess.TimeoutExpired:
+                                logger.warning("Timed out hashing video %s, keeping its path", fullpath)
+                                continue
                             logger.info("Video MD5 is %s", vid_md5)
                             if vid_md5 == docmd5:
                                 logger.info("MD5 match for video %s", fullpath)
@@ -136,6 +150,7 @@ def main():
                             )
                             # pull relpath from current document by ID in Mongo
         # TODO: add logic to process video entries as well
+        close_hash_cache()
         break
 
 
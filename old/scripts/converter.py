@@ -1,13 +1,13 @@
+import concurrent.futures
 import datetime
 import logging
 import os
+import subprocess
 import sys
 import time
 from configparser import ConfigParser
 
-from moviepy.editor import VideoFileClip
-
-from dependencies.fileops import listdirs, listvideos
+from dependencies.fileops import configure_ffmpeg_pool, listdirs, listvideos
 
 # initialize logger
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
@@ -19,6 +19,8 @@ config = ConfigParser()
 config.read('config.ini')
 subdiv = config.get('properties', 'subdiv')
 rootdir = config.get('divs', subdiv)
+ffmpeg_pool = configure_ffmpeg_pool(config.getint('properties', 'ffmpeg_workers', fallback=2),
+                                    config.getint('properties', 'ffmpeg_convert_timeout', fallback=3600))
 
 allfolders = listdirs(rootdir)
 
@@ -28,19 +30,32 @@ def convert_video_to_mp4(file_path):
     folder_path, origfilename = os.path.split(file_path)
     name, file_ext = os.path.splitext(origfilename)
     mp4_filename = f"{name}.mp4"
-    clip = VideoFileClip(folder_path + "\\" + origfilename)
-    if os.path.isfile(folder_path + "\\" + "converted_" + mp4_filename):
-        logger.warning("File %s\\%s already converted", folder_path, mp4_filename)
+    converted_path = os.path.join(folder_path, "converted_" + mp4_filename)
+    if os.path.isfile(converted_path):
+        logger.warning("File %s already converted", converted_path)
     else:
-        clip.write_videofile(folder_path + "\\" + "converted_" + mp4_filename)
-    clip.close()
-    os.remove(folder_path + "\\" + origfilename)
+        try:
+            returncode, out, err = ffmpeg_pool.run(["-i", file_path, "-c:v", "libx264", "-c:a", "aac", "-n",
+                                                    converted_path])
+        except subprocess.TimeoutExpired:
+            logger.error("Conversion of %s timed out", file_path)
+            if os.path.isfile(converted_path):
+                os.remove(converted_path)
+            return
+        if returncode != 0:
+            logger.error("Conversion of %s failed: %s", file_path, err)
+            if os.path.isfile(converted_path):
+                os.remove(converted_path)
+            return
+    os.remove(file_path)
     logger.info(f"Conversion successful. {name} converted to {mp4_filename}.")
 
 
 def main():
     videocount = 0
     start_time = time.time()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=ffmpeg_pool.max_concurrent)
+    futures = {}
     while True:
         if allfolders:
             workingdir = allfolders.pop(0)
@@ -49,8 +64,18 @@ def main():
                 videocount += 1
                 videoname, videoext = os.path.splitext(videopath)
                 if videoext in [".webm", ".mkv"]:
-                    convert_video_to_mp4(videopath)
+                    futures[pool.submit(convert_video_to_mp4, videopath)] = videopath
         else:
+            failed = 0
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    failed += 1
+                    logger.error("Exception converting %s: %s", futures[future], future.exception(),
+                                 exc_info=future.exception())
+            pool.shutdown(wait=True)
+            if failed:
+                logger.error("%s of %s conversions raised an exception", failed, len(futures))
+            logger.info("ffmpeg stats: %s", ffmpeg_pool.stats())
             elapsed_time = time.time() - start_time
             final_time = str(datetime.timedelta(seconds=elapsed_time))
             logger.info("All entries processed. Root folder: %s Folder list: %s", rootdir, allfolders)
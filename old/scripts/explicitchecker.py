@@ -9,6 +9,7 @@ import pymongo
 
 from dependencies.fileops import (get_image_content, get_image_md5, get_video_content, get_video_content_md5, listdirs,
                                   listimages, listvideos)
+from dependencies.responsecache import ResponseCache
 from dependencies.vision import Tagging
 from dependencies.vision_video import VideoData
 
@@ -33,6 +34,7 @@ process_images = config.getboolean("storage", "process_images")
 google_credentials = config.get("image-recognition", "google-credentials")
 google_project = config.get("image-recognition", "google-project")
 tags_backend = config.get("image-recognition", "backend")
+responsecache = config.get("storage", "responsecache", fallback="responses.db")
 
 # initialize DBs
 currentdb = pymongo.MongoClient(connectstring)[mongodbname]
@@ -50,7 +52,8 @@ videocollection.create_index("vision_tags")
 
 # define folder and image lists globally
 imagelist = []
-tagging = Tagging(google_credentials, google_project, tags_backend)
+response_cache = ResponseCache(responsecache) if responsecache else None
+tagging = Tagging(google_credentials, google_project, tags_backend, cache=response_cache)
 allfolders = listdirs(rootdir)
 
 # Names of likelihood from google.cloud.vision.enums
@@ -94,7 +97,7 @@ def main():
                     image_content = get_image_content(imagepath)
                     # noinspection PyUnresolvedReferences
                     try:
-                        safe = tagging.get_explicit(image_binary=image_content)
+                        safe = tagging.get_explicit(image_binary=image_content, media=im_md5)
                         workingcollection.update_one(
                             {"md5": im_md5},
                             {
@@ -144,8 +147,8 @@ def main():
                     try:
                         logger.info("Processing video %s", relpath)
                         video_content = get_video_content(videopath)
-                        videoobj = VideoData(google_credentials, google_project)
-                        videoobj.video_vision_explicit(video_content)
+                        videoobj = VideoData(google_credentials, google_project, cache=response_cache)
+                        videoobj.video_vision_explicit(video_content, video_content_md5)
                         workingcollection.update_one(
                             {"content_md5": video_content_md5},
                             {"$set": {"explicit_detection": videoobj.pornography}},
@@ -8,7 +8,8 @@ import exiftool
 import pymongo
 from bson.json_util import dumps, loads
 
-from dependencies.fileops import (get_image_md5, get_video_content_md5, listdirs, listimages, listvideos, )
+from dependencies.fileops import (close_hash_cache, get_image_md5, get_video_content_md5, listdirs, listimages,
+                                  listvideos, open_hash_cache)
 
 # initialize logger
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
@@ -35,6 +36,7 @@ mongoscreenshotcollection = config.get("storage", "mongoscreenshotcollection")
 mongovideocollection = config.get("storage", "mongovideocollection")
 process_videos = config.getboolean("flags", "process_videos")
 process_images = config.getboolean("flags", "process_images")
+open_hash_cache(config.get("storage", "hashcache", fallback="hashcache.db"))
 
 # initialize DBs
 currentdb = pymongo.MongoClient(connectstring)[mongodbname]
@@ -269,6 +271,7 @@ def main():
             print(imagecount, "images and ", videocount, "videos processed.")
             print("Processing took ", final_time)
             et.terminate()
+            close_hash_cache()
             break
 
 
@@ -11,7 +11,8 @@ import exiftool
 import pymongo
 from bson.json_util import dumps, loads
 
-from dependencies.fileops import (get_image_md5, get_video_content_md5, listdirs, listimages, listvideos)
+from dependencies.fileops import (close_hash_cache, get_image_md5, get_video_content_md5, listdirs, listimages,
+                                  listvideos, open_hash_cache)
 
 # read config
 config = ConfigParser()
@@ -27,6 +28,7 @@ maxlength = config.getint("properties", "maxlength")
 threads = config.getint("properties", "threads")
 connectstring = config.get('storage', 'connectionstring')
 mongodbname = config.get('storage', 'mongodbname')
+hashcache = config.get("storage", "hashcache", fallback="hashcache.db")
 
 # initialize logger
 log_level_dict = {
@@ -174,6 +176,7 @@ def processvideofolder(workingdir, et):
 def main():
     global foldercount, folderlist
     start_time = time.time()
+    open_hash_cache(hashcache)
     pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
     et = exiftool.ExifToolHelper(logger=logging.getLogger(__name__).setLevel(logging.INFO), encoding="utf-8")
     for div in subdivs:
@@ -216,6 +219,7 @@ def main():
     logger.info("Folders processed: %s", folderlist)
     print(imagecount, "images and ", videocount, "videos processed.")
     print("Processing took ", final_time)
+    close_hash_cache()
 
 
 if __name__ == "__main__":
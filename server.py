@@ -1,16 +1,25 @@
 import json
 import logging
 import os
+import signal
 import sys
 import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import pymongo
 from redis import Redis
 
 from dependencies.configops import MainConfig
-from dependencies.fileops import (get_image_content, get_image_md5, get_video_content, get_video_content_md5, )
-from dependencies.vision import Tagging
+from dependencies.fileops import configure_ffmpeg_pool, get_video_content, get_video_md5
+from dependencies.jobqueue import BatchPrefetcher, ack_jobs, pull_batch, requeue_jobs
+from dependencies.media import ImageMedia
+from dependencies.mongowriter import BulkWriter
+from dependencies.ratelimit import ApiLimiter
+from dependencies.responsecache import ResponseCache
+from dependencies.vision import AsyncTagging, Tagging
 from dependencies.vision_video import VideoData
+from dependencies.visionupload import UploadPreprocessor
 
 # read config
 config = MainConfig("config.ini")
@@ -20,6 +29,12 @@ currentdb = pymongo.MongoClient(config.connectstring)[config.mongodbname]
 collection = currentdb[config.mongocollection]
 screenshotcollection = currentdb[config.mongoscreenshotcollection]
 videocollection = currentdb[config.mongovideocollection]
+REDIS_CLIENT = Redis(host="localhost", port=6379, db=0)
+# jobs this worker has pulled and not finished, see worker in config-example.ini
+PROCESSING_KEY = f"queue:processing:{config.worker}"
+
+configure_ffmpeg_pool(config.ffmpeg_workers, config.ffmpeg_timeout, config.ffmpeg_content_timeout)
+writer = BulkWriter(currentdb, config.writebatch, config.writeinterval, config.mongofailed)
 
 # Initialize models
 if "deepb" in config.configmodels:
@@ -28,12 +43,35 @@ if "deepb" in config.configmodels:
     modelpath = config.deepbmodelpath
     tagfile = config.deepbtagfile
     threshold = config.deepbthreshold
-    deepb_tagger = deepb.deepdanbooruModel(threshold, modelpath, tagfile)
+    deepb_tagger = deepb.deepdanbooruModel(threshold, modelpath, tagfile, config.deepbfastdecode)
 
 # Initialize variables
+# API rate limits are shared by every server.py through Redis
+vision_limiter = ApiLimiter("vision", REDIS_CLIENT, config.visionrate, max_concurrency=config.visionconcurrency,
+                            retries=config.apiretries)
+video_limiter = ApiLimiter("videointelligence", REDIS_CLIENT, config.videorate,
+                           max_concurrency=config.videoconcurrency, retries=config.apiretries)
+response_cache = (
+    ResponseCache(config.responsecache, config.responsecachesize * 1024 * 1024) if config.responsecache else None
+)
 tagging = Tagging(
-    config.google_credentials, config.google_project, tags_backend="google-vision"
+    config.google_credentials, config.google_project, tags_backend="google-vision",
+    endpoint=config.vision_endpoint, limiter=vision_limiter, cache=response_cache,
 )
+uploader = UploadPreprocessor(
+    config.visionmaxside, config.visionuploadformat, config.visionuploadquality, config.visionscreenshotfullres
+) if config.visionmaxside > 0 else None
+vision_async = AsyncTagging(tagging, config.visioninflight) if config.visionmode == "async" else None
+deepb_results = {}
+vision_results = {}
+media_totals = {"jobs": 0, "reads": 0, "decodes": 0, "bytes": 0}
+hash_totals = {"trusted": 0, "rehashed": 0}
+# models left out of jobs because their results already exist
+skip_totals = {"vision": 0, "deepb": 0, "video": 0}
+# (collection, md5) -> models tagged by this worker lately, since buffered writes may not be in MongoDB yet
+recent_tagged = OrderedDict()
+RECENT_TAGGED_SIZE = 100000
+hash_totals_lock = threading.Lock()
 imagecount = 0
 videocount = 0
 foldercount = 0
@@ -58,151 +96,221 @@ logging.debug("logging started")
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-REDIS_CLIENT = Redis(host="localhost", port=6379, db=0)
+# per-model fields of an image document, None until a job fills them in
+IMAGE_RESULT_FIELDS = ("vision_tags", "vision_text", "explicit_detection", "deepbtags")
+# field the video identity is stored under, see videohash in config-example.ini
+video_md5_field = "packet_md5" if config.videohash == "packet" else "content_md5"
 
 
-def pull(key):
-    return REDIS_CLIENT.blpop(key)
-
-
-def process_image(imagepath, workingcollection, subdiv, is_screenshot, models):
-    # TODO: handle update/create in redis instead of checking, support getting explicit tags
-    im_md5 = get_image_md5(imagepath)
-    image_content = get_image_content(imagepath)
-    imagepath_array = [imagepath]
-    # Check if entry exists in MongoDB, then create new entry or update entry by MD5
-    entry = collection.find_one(
-        {"md5": im_md5},
-        {
-            "md5": 1,
-            "vision_tags": 1,
-            "vision_text": 1,
-            "deepbtags": 1,
-            "explicit_detection": 1,
-        },
-    )
-    if entry is None:
-        mongo_entry = create_imagedoc(
-            image_content, im_md5, imagepath_array, is_screenshot, subdiv, models
-        )
-        workingcollection.insert_one(mongo_entry)
-        logger.info(
-            "Added new entry in MongoDB for image %s: %s\n", imagepath, mongo_entry
-        )
-    else:
-        # Make sure tagging doesn't run twice
-        deeptest = entry.get("deepbtags")
-        deeplen = len(entry.get("deepbtags"))
-        if "deepb" in models and entry.get("deepbtags") is None:
-            logger.info("Processing DeepB tags for image %s", imagepath)
-            deepbtags = deepb_tagger.classify_image(imagepath)
-            collection.update_one(
-                {"md5": im_md5}, {"$set": {"deepbtags": deepbtags[1]}}
-            )
-        elif "deepb" in models and len(entry.get("deepbtags")) == 0:
-            logger.info("Processing DeepB tags for image %s", imagepath)
-            deepbtags = deepb_tagger.classify_image(imagepath)
-            collection.update_one(
-                {"md5": im_md5}, {"$set": {"deepbtags": deepbtags[1]}}
-            )
+def job_md5(job):
+    # the hash client.py computed, if the file's size and mtime haven't changed since; None means rehash
+    md5 = None
+    if job.get("md5", "corrupt") != "corrupt" and (job["type"] == "image" or job.get("videohash") == config.videohash):
+        try:
+            stat = os.stat(job["path"])
+        except OSError:
+            stat = None
+        if stat is not None and stat.st_size == job.get("size") and stat.st_mtime_ns == job.get("mtime_ns"):
+            md5 = job["md5"]
+    return md5
+
+
+def count_hash(trusted):
+    with hash_totals_lock:
+        hash_totals["trusted" if trusted else "rehashed"] += 1
+
+
+def load_deepb_input(media):
+    try:
+        return media.deepb_input(deepb_tagger)
+    except (OSError, SyntaxError) as e:
+        logger.error("Error %s processing %s", e, media.path)
+        return None
+
 
-        if "vision" in models and entry.get("vision_tags") is None:
-            # TODO: add Mongo checks for Vision because of expense
-            logger.warning("Not processing vision tags yet")
-            # collection.update_one()
-        if "deepdetect" in models and entry["deepdetect_tags"] is None:
-            logger.warning("Not processing deepdetect tags yet")
-            # collection.update_one()
-    # logger.info("Updated MongoDB entry for image %s \n", imagepath)
+def classify_deepb(media):
+    # results computed for the whole batch in process_jobs, falling back to classifying one image
+    if media.path in deepb_results:
+        return deepb_results.pop(media.path)
+    images, indexes = deepb_tagger.stack_images([load_deepb_input(media)])
+    media.release()
+    return deepb_tagger.classify_loaded(1, images, indexes)[0]
 
 
-def create_imagedoc(image_content, im_md5, image_array, is_screenshot, subdiv, models):
-    tags, text, safe, deepbtags, explicit_detection = None, None, None, None, None
+def vision_features(is_screenshot):
+    # screenshots only need their text
+    return ("text",) if is_screenshot == 1 else ("text", "tags", "explicit")
+
+
+def annotate_vision(media, is_screenshot):
+    # results annotated for the whole batch in process_jobs, falling back to annotating one image
+    annotations = vision_results.pop(media.path, None)
+    if isinstance(annotations, Future):
+        annotations = annotations.result()
+    if annotations is None:
+        annotations = tagging.annotate(media.vision_content(uploader, is_screenshot), vision_features(is_screenshot),
+                                       media.md5())
+    if isinstance(annotations, Exception):
+        raise annotations
+    return annotations
+
+
+def process_image(imagepath, workingcollection, subdiv, is_screenshot, models, media):
+    # One upsert per image, with no read first: the models the client asked for are $set, fields nothing has
+    # filled in yet start out as None, and the path joins the list, so two jobs for the same image can't clash
+    im_md5 = media.md5()
+    if im_md5 == "corrupt":
+        # every unreadable image hashes the same, so it would be tagged and written over one shared document
+        logger.error("Image %s can't be read, not tagging it", imagepath)
+        return
+    results = tag_image(is_screenshot, models, media)
+    update = {
+        "$setOnInsert": {
+            "subdiv": subdiv,
+            "is_screenshot": is_screenshot,
+            **{field: None for field in IMAGE_RESULT_FIELDS if field not in results},
+        },
+        "$addToSet": {"path": imagepath},
+    }
+    if results:
+        update["$set"] = results
+    writer.update(workingcollection, {"md5": im_md5}, update)
+    remember_tagged(workingcollection, im_md5, {model for model, field in (("vision", "vision_text"),
+                                                                          ("deepb", "deepbtags")) if field in results})
+    logger.info("Queued MongoDB upsert for image %s: %s\n", imagepath, results)
+
+
+def tag_image(is_screenshot, models, media):
+    # returns only the fields this job computed
+    results = {}
     if "deepb" in models and "deepb" not in config.configmodels:
         logger.error("Client requested DeepB tags but DeepB is disabled in config")
-    if "deepb" in models and is_screenshot != 1:
-        deepbtags = deepb_tagger.classify_image(image_array[0])
-        deepbtags = deepbtags[1]
+    elif "deepb" in models and is_screenshot != 1:
+        results["deepbtags"] = classify_deepb(media)[1]
     if "vision" in models:
-        text = tagging.get_text(image_binary=image_content)
-        text = [text[0]]
+        # one request for every feature
+        annotations = annotate_vision(media, is_screenshot)
+        results["vision_text"] = [annotations["text"][0]]
         if is_screenshot != 1:
-            tags = tagging.get_tags(image_binary=image_content)
-            safe = tagging.get_explicit(image_binary=image_content)
-            explicit_detection = {
+            results["vision_tags"] = annotations["tags"]
+            safe = annotations["explicit"]
+            results["explicit_detection"] = {
                 "adult": f"{likelihood_name[safe.adult]}",
                 "medical": f"{likelihood_name[safe.medical]}",
                 "spoofed": f"{likelihood_name[safe.spoof]}",
                 "violence": f"{likelihood_name[safe.violence]}",
                 "racy": f"{likelihood_name[safe.racy]}",
             }
-            explicit_detection = [explicit_detection][0]
     if "deepdetect" in models:
         logger.warning("Not processing deepdetect tags yet")
+    return results
 
-    mongo_entry = {
-        "md5": im_md5,
-        "vision_tags": tags,
-        "vision_text": text,
-        "explicit_detection": explicit_detection,
-        "deepbtags": deepbtags,
-        "path": image_array,
-        "subdiv": subdiv,
-        "is_screenshot": is_screenshot,
-    }
 
-    logger.info("Generated MongoDB entry: %s", mongo_entry)
-    return mongo_entry
-
-
-def process_video(videopath, workingcollection, subdiv, models, rootdir=""):
-    video_content_md5 = str(get_video_content_md5(videopath))
-    # TODO: update to check explicit_detection
-    entry = videocollection.find_one(
-        {"content_md5": video_content_md5},
-        {
-            "content_md5": 1,
-            "vision_tags": 1,
-            "vision_text": 1,
-            "vision_transcript": 1,
-            "explicit_detection": 1,
-        },
-    )
-    if "vision" in models and entry is None:
-        relpath = os.path.relpath(videopath, rootdir)
-        video_content = get_video_content(videopath)
-        vidpath_array = [videopath]
-        relpath_array = [relpath]
-        mongo_entry = create_videodoc(
-            video_content, video_content_md5, vidpath_array, relpath_array, subdiv
-        )
-        workingcollection.insert_one(mongo_entry)
-        logger.info("Added new entry in MongoDB for video %s \n", videopath)
+def process_video(videopath, workingcollection, subdiv, models, rootdir="", video_md5=None):
+    if "vision" not in models:
+        logger.info("Nothing to do for video %s with models %s\n", videopath, models)
+        return
+    if video_md5 is None:
+        video_md5 = str(get_video_md5(videopath, config.videohash))
+    if video_md5 == "corrupt":
+        logger.error("Video %s can't be read, not tagging it", videopath)
+        return
+    update = {"$setOnInsert": {"subdiv": subdiv}, "$addToSet": {"path": videopath}}
+    if rootdir:
+        update["$addToSet"]["relativepath"] = os.path.relpath(videopath, rootdir)
     else:
-        logger.info("MongoDB entry for video %s already exists: %s \n", videopath, entry)
+        logger.warning("No div configured for subdiv %s, not recording a relative path for %s", subdiv, videopath)
+    if video_tagged(workingcollection, video_md5):
+        # already tagged, only the path is new
+        skip_totals["video"] += 1
+        logger.info("Video %s already has Vision results, recording its path only", videopath)
+    else:
+        update["$set"] = tag_video(get_video_content(videopath), video_md5)
+        remember_tagged(workingcollection, video_md5, {"vision"})
+    writer.update(workingcollection, {video_md5_field: video_md5}, update)
+    logger.info("Queued MongoDB upsert for video %s \n", videopath)
+
+
+def video_tagged(workingcollection, video_md5):
+    # one lookup per video, which costs nothing next to a Video Intelligence call
+    if "vision" in recent_tagged.get((workingcollection.name, video_md5), ()):
+        return True
+    document = workingcollection.find_one({video_md5_field: video_md5, "vision_tags": {"$ne": None}}, {"_id": 1})
+    return document is not None
 
 
-def create_videodoc(
-    video_content, video_content_md5, vidpath_array, relpath_array, subdiv
-):
-    videoobj = VideoData(config.google_credentials, config.google_project)
-    videoobj.video_vision_all(video_content)
-    mongo_entry = {
-        "content_md5": video_content_md5,
+def remember_tagged(workingcollection, md5, models):
+    if not models:
+        return
+    key = (workingcollection.name, md5)
+    recent_tagged[key] = recent_tagged.get(key, set()) | set(models)
+    recent_tagged.move_to_end(key)
+    while len(recent_tagged) > RECENT_TAGGED_SIZE:
+        recent_tagged.popitem(last=False)
+
+
+def image_collection(job):
+    return screenshotcollection if job["subdiv"] == "screenshot" else collection
+
+
+def finished_models(document, is_screenshot):
+    # screenshots only get text, so theirs is the field that shows Vision ran
+    done = set()
+    if document.get("vision_text" if is_screenshot == 1 else "vision_tags") is not None:
+        done.add("vision")
+    if document.get("deepbtags"):
+        done.add("deepb")
+    return done
+
+
+def skip_tagged(jobs, media):
+    # Drops models from image jobs whose image already has their results, in MongoDB, from a job this worker ran
+    # lately, or from an earlier job in the same batch, so duplicate jobs and "process all" rescans don't pay for
+    # Vision again or overwrite what's stored. One query per collection per batch. Jobs left with no models still
+    # record their path.
+    md5s = {}
+    for job in jobs:
+        if job["type"] == "image" and job["models"]:
+            try:
+                md5 = media[job["path"]].md5()
+            except Exception:
+                continue  # left to the job itself, which logs the error
+            if md5 != "corrupt":
+                md5s[job["path"]] = md5
+    documents = {}
+    for workingcollection in {image_collection(job) for job in jobs if job["path"] in md5s}:
+        wanted = list({md5s[job["path"]] for job in jobs if job["path"] in md5s and
+                       image_collection(job) is workingcollection})
+        for document in workingcollection.find({"md5": {"$in": wanted}},
+                                               {"md5": 1, "vision_tags": 1, "vision_text": 1, "deepbtags": 1}):
+            documents[(workingcollection.name, document["md5"])] = document
+    claimed = set()
+    for job in jobs:
+        if job["path"] not in md5s:
+            continue
+        key = (image_collection(job).name, md5s[job["path"]])
+        done = finished_models(documents.get(key, {}), job.get("is_screenshot"))
+        done |= recent_tagged.get(key, set())
+        done |= {model for model in job["models"] if (key, model) in claimed}
+        for model in job["models"]:
+            if model in done and model in skip_totals:
+                skip_totals[model] += 1
+        job["models"] = [model for model in job["models"] if model not in done]
+        claimed.update((key, model) for model in job["models"])
+
+
+def tag_video(video_content, video_md5=None):
+    videoobj = VideoData(config.google_credentials, config.google_project, video_limiter, response_cache)
+    videoobj.video_vision_all(video_content, video_md5)
+    return {
         "vision_tags": videoobj.labels,
         "vision_text": videoobj.text,
         "vision_transcript": videoobj.transcripts,
         "explicit_detection": videoobj.pornography,
-        "path": vidpath_array,
-        "subdiv": subdiv,
-        "relativepath": relpath_array,
     }
-    return mongo_entry
 
 
-while True:
-    logger.info("Waiting for job")
-    job = json.loads(pull("queue")[1])
+def process_job(job, media=None):
     if job["type"] == "image":
         print("Processing image, job is", job)
         if job["subdiv"] == "screenshot" and job['models'] is not None:
@@ -212,6 +320,7 @@ while True:
                 job["subdiv"],
                 job["is_screenshot"],
                 job["models"],
+                media,
             )
         elif job['models'] is not None: process_image(
                 job["path"],
@@ -219,7 +328,201 @@ while True:
                 job["subdiv"],
                 job["is_screenshot"],
                 job["models"],
+                media,
             )
     elif job["type"] == "video" and job['models'] is not None:
         print("Processing video, job is", job)
-        process_video(job["path"], videocollection, job["subdiv"], job["models"])
+        video_md5 = job_md5(job)
+        count_hash(video_md5 is not None)
+        rootdir = config.getdiv(job["subdiv"]) if config.config.has_option("divs", job["subdiv"]) else ""
+        process_video(job["path"], videocollection, job["subdiv"], job["models"], rootdir, video_md5)
+
+
+def deepb_paths(jobs):
+    return [job["path"] for job in jobs if job["type"] == "image" and "deepb" in (job["models"] or [])
+            and job.get("is_screenshot") != 1]
+
+
+def pull_jobs(timeout=0):
+    # raw job payloads, moved onto PROCESSING_KEY until ack_jobs() once they're processed
+    return pull_batch(REDIS_CLIENT, "queue", config.jobbatch, config.jobwait, PROCESSING_KEY, timeout)
+
+
+def decode_jobs(raw):
+    jobs = []
+    for job in raw:
+        try:
+            jobs.append(json.loads(job))
+        except ValueError as e:
+            logger.error("Dropping malformed job %r: %s", job, e)
+    return jobs
+
+
+def prepare_media(media, deepb, vision=False, is_screenshot=None):
+    # runs on the decoder pool: hashes the image and builds its deepb input and Vision upload from the same decode,
+    # then drops the raster so prefetched batches only hold file bytes
+    try:
+        media.md5()
+        inputs = load_deepb_input(media) if deepb else None
+        if vision and uploader is not None:
+            try:
+                media.vision_content(uploader, is_screenshot)
+            except Exception:
+                pass  # left to the job itself, which logs the error
+        return inputs
+    finally:
+        media.release()
+
+
+def prepare_jobs(jobs):
+    # runs on the prefetch thread, reading, hashing and decoding the batch's images while the previous batch is tagged
+    media = {job["path"]: ImageMedia(job["path"], md5=job_md5(job)) for job in jobs if job["type"] == "image"}
+    deepbpaths = deepb_paths(jobs) if "deepb" in config.configmodels else []
+    wanted = set(deepbpaths)
+    # is_screenshot of each image whose Vision upload is prepared here too
+    vision = {}
+    if "vision" in config.configmodels:
+        vision = {job["path"]: job.get("is_screenshot") for job in jobs
+                  if job["type"] == "image" and "vision" in (job["models"] or [])}
+    inputs = dict(zip(media, decoder_pool.map(
+        lambda path: prepare_media(media[path], path in wanted, path in vision, vision.get(path)), media
+    )))
+    if not deepbpaths:
+        return media, None
+    images, indexes = deepb_tagger.stack_images(inputs[path] for path in deepbpaths)
+    return media, (deepbpaths, images, indexes)
+
+
+def process_jobs(jobs, prepared=None):
+    media, decoded = prepared if prepared is not None else ({}, None)
+    for job in jobs:
+        if job["type"] == "image" and job["path"] not in media:
+            media[job["path"]] = ImageMedia(job["path"], md5=job_md5(job))
+    try:
+        skip_tagged(jobs, media)
+    except Exception as e:
+        logger.error("Exception checking for existing results, tagging the whole batch: %s", e, exc_info=True)
+    # Vision requests go out first, so in async mode they're in flight while deepb runs
+    if "vision" in config.configmodels:
+        try:
+            start_vision(jobs, media)
+        except Exception as e:
+            logger.error("Exception starting Vision for the batch, falling back to single images: %s", e, exc_info=True)
+    # deepb runs once over every image in the batch that asks for it
+    if "deepb" in config.configmodels:
+        deepbpaths = deepb_paths(jobs)
+        if deepbpaths:
+            try:
+                if decoded is not None:
+                    # decoded before skip_tagged, so it can cover images whose deepb has been dropped since
+                    paths, images, indexes = decoded
+                    results = deepb_tagger.classify_loaded(len(paths), images, indexes, config.deepbbatch)
+                else:
+                    paths = deepbpaths
+                    results = deepb_tagger.classify_images(deepbpaths, config.deepbbatch)
+                wanted = set(deepbpaths)
+                deepb_results.update((path, result) for path, result in zip(paths, results) if path in wanted)
+            except Exception as e:
+                logger.error("Exception running batched deepb, falling back to single images: %s", e, exc_info=True)
+    # one failed job is logged and skipped instead of taking the rest of the batch down with it
+    for job in jobs:
+        jobmedia = None
+        if job["type"] == "image":
+            jobmedia = media[job["path"]]
+            # counted here rather than in job_md5, which runs twice for a batch whose preparation failed
+            count_hash(jobmedia.trusted_md5)
+        try:
+            process_job(job, jobmedia)
+        except Exception as e:
+            logger.error("Exception processing job %s: %s", job, e, exc_info=True)
+        if jobmedia is not None:
+            jobmedia.release()
+            stats = jobmedia.stats()
+            logger.info("Image job stats for %s: %s", job["path"], stats)
+            media_totals["jobs"] += 1
+            for key, value in stats.items():
+                media_totals[key] += value
+    deepb_results.clear()
+    vision_results.clear()
+
+
+def start_vision(jobs, media):
+    # "batch" annotates the batch's images in batch_annotate_images requests, "async" submits one request per image
+    # to the asyncio client and leaves the futures for the jobs to collect, "single" leaves it all to the jobs
+    visionjobs = {}
+    for job in jobs:
+        if job["type"] == "image" and "vision" in (job["models"] or []) and job["path"] not in visionjobs:
+            try:
+                md5 = media[job["path"]].md5()
+                if md5 == "corrupt":
+                    continue  # not tagged at all, see process_image
+                content = media[job["path"]].vision_content(uploader, job.get("is_screenshot"))
+            except Exception:
+                continue  # left to the job itself, which logs the error
+            visionjobs[job["path"]] = (content, vision_features(job.get("is_screenshot")), md5)
+    if config.visionmode == "async":
+        for path, (content, features, md5) in visionjobs.items():
+            vision_results[path] = vision_async.submit(content, features, md5)
+    elif config.visionmode == "batch" and config.visionbatch > 1 and len(visionjobs) > 1:
+        items = list(visionjobs.values())
+        try:
+            vision_results.update(zip(visionjobs, tagging.annotate_batch(items, config.visionbatch)))
+        except Exception as e:
+            logger.error("Exception running batched Vision, falling back to single images: %s", e, exc_info=True)
+
+
+decoder_pool = ThreadPoolExecutor(max_workers=config.deepbdecoders, thread_name_prefix="image-decode")
+requeued = requeue_jobs(REDIS_CLIENT, "queue", PROCESSING_KEY)
+if requeued:
+    logger.warning("Requeued %s jobs the last run of worker %s didn't finish", requeued, config.worker)
+# batches are only pulled ahead of time to overlap their decoding with deepb inference
+prefetcher = None
+if "deepb" in config.configmodels:
+    prefetcher = BatchPrefetcher(
+        lambda: pull_jobs(timeout=1), lambda raw: prepare_jobs(decode_jobs(raw)), config.deepbprefetch
+    )
+
+# SIGTERM exits through the finally below, so buffered writes are flushed and unfinished jobs requeued
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+writer.replay_failed()
+try:
+    while True:
+        logger.info("Waiting for job")
+        if prefetcher is not None:
+            raw, prepared = prefetcher.next()
+            batch = decode_jobs(raw)
+            logger.info("Pulled %s jobs, prefetch %s", len(raw), prefetcher.stats())
+        else:
+            raw = pull_jobs()
+            batch = decode_jobs(raw)
+            logger.info("Pulled %s jobs", len(raw))
+            # still read and hash the batch's images on the decoder pool, just not ahead of time
+            try:
+                prepared = prepare_jobs(batch)
+            except Exception as e:
+                logger.error("Exception preparing job batch: %s", e, exc_info=True)
+                prepared = None
+        process_jobs(batch, prepared)
+        # a job only leaves the processing list once its results are written (or saved to mongofailed)
+        writer.flush()
+        ack_jobs(REDIS_CLIENT, PROCESSING_KEY, raw)
+        logger.info("Image totals: %s, job hashes: %s, already tagged: %s, MongoDB writes: %s, Vision: %s",
+                    media_totals, hash_totals, skip_totals, writer.stats(),
+                    vision_async.stats() if vision_async is not None else tagging.stats())
+        logger.info("API limits: Vision %s, Video Intelligence %s", vision_limiter.stats(), video_limiter.stats())
+        if response_cache is not None:
+            logger.info("Response cache: %s", response_cache.stats())
+        if uploader is not None:
+            logger.info("Vision uploads: %s", uploader.stats())
+finally:
+    if prefetcher is not None:
+        prefetcher.close()
+    writer.close()
+    try:
+        logger.info("Requeued %s unfinished jobs", requeue_jobs(REDIS_CLIENT, "queue", PROCESSING_KEY))
+    except Exception as e:
+        logger.error("Couldn't requeue unfinished jobs, they're requeued on the next start: %s", e)
+    if vision_async is not None:
+        vision_async.close()
+    if response_cache is not None:
+        response_cache.close()
@@ -9,7 +9,7 @@ from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
 
 from dependencies.configops import MainConfig
-from dependencies.fileops import get_image_md5
+from dependencies.fileops import close_hash_cache, get_image_md5, open_hash_cache
 from old.main_threaded import process_image, process_video
 from old.tagwriter_threaded import getimagetags, writeimagetags
 
@@ -21,6 +21,8 @@ currentdb = pymongo.MongoClient(config.connectstring)[config.mongodbname]
 collection = currentdb[config.mongocollection]
 videocollection = currentdb[config.mongovideocollection]
 
+open_hash_cache(config.hashcache)
+
 # initialize logger
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("PIL").setLevel(logging.ERROR)
@@ -146,3 +148,4 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             exit_event.set()
             logger.info("Keyboard interrupt received, exiting")
+    close_hash_cache()